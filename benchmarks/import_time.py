@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+"""Measure how long it takes to load the plugin through its entry point.
+
+Each sample runs in a fresh interpreter so that nothing is cached in
+sys.modules. Besides the timings, the script reports which of the heavy
+optional modules were pulled in by merely loading the plugin.
+
+Usage: python benchmarks/import_time.py [number of runs]
+"""
+
+import subprocess
+import sys
+
+PLUGIN_MODULE = 'mediacoreext.simplestation.panda.mediacore_plugin'
+HEAVY_MODULES = [
+    'panda',
+    'simplejson',
+    'tw.forms',
+    'mediacoreext.simplestation.panda.forms.admin.storage',
+]
+
+SAMPLE_SCRIPT = '''
+import sys, time
+# Load MediaCore itself first, it is always present when plugins are loaded.
+import mediacore.lib.storage, mediacore.plugin.events
+start = time.time()
+import %(module)s
+elapsed = time.time() - start
+print elapsed
+print ','.join(m for m in %(heavy)r if m in sys.modules)
+'''
+
+def sample():
+    script = SAMPLE_SCRIPT % {'module': PLUGIN_MODULE, 'heavy': HEAVY_MODULES}
+    output = subprocess.check_output([sys.executable, '-c', script])
+    lines = output.splitlines()
+    elapsed = float(lines[0])
+    loaded = [m for m in lines[1].split(',') if m]
+    return elapsed, loaded
+
+def main(runs=10):
+    timings = []
+    loaded = set()
+    for i in range(runs):
+        elapsed, modules = sample()
+        timings.append(elapsed)
+        loaded.update(modules)
+    timings.sort()
+    print 'plugin import time over %d runs:' % runs
+    print '  min    %.1f ms' % (timings[0] * 1000)
+    print '  median %.1f ms' % (timings[len(timings) // 2] * 1000)
+    print '  max    %.1f ms' % (timings[-1] * 1000)
+    print 'heavy modules loaded at import: %s' % (', '.join(sorted(loaded)) or 'none')
+
+if __name__ == '__main__':
+    runs = 10
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+    main(runs)
@@ -0,0 +1,346 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Paster commands for running Panda jobs outside of web requests.
+
+All commands take the path to the MediaCore deployment config file, e.g.::
+
+    paster panda-worker deployment.ini
+
+"""
+
+import logging
+import os
+import time
+from datetime import datetime
+
+from paste.script.command import BadCommand, Command
+
+log = logging.getLogger(__name__)
+
+class PandaCommand(Command):
+    """Base class for commands that need a fully configured MediaCore app."""
+    min_args = 1
+    max_args = 1
+    usage = 'CONFIG_FILE'
+    group_name = 'mediacore-panda'
+
+    def load_app(self):
+        from paste.deploy import loadapp
+        from paste.script.util.logging_config import fileConfig
+
+        config_file = os.path.abspath(self.args[0])
+        fileConfig(config_file)
+        # Loading the app sets up the MediaCore environment, database
+        # connection and plugins.
+        loadapp('config:' + config_file)
+
+    def setup_request(self, base_url):
+        """Register a fake request so that URLs can be generated.
+
+        :param base_url: The public URL of the MediaCore site, as Panda must
+            be able to reach it (e.g. http://example.com/).
+        """
+        import pylons
+        from paste.registry import Registry
+        from pylons.util import ContextObj
+        from routes import request_config
+        from routes.util import URLGenerator
+        from webob import Request
+
+        environ = Request.blank('/', base_url=base_url).environ
+        registry = Registry()
+        registry.prepare()
+        registry.register(pylons.request, pylons.Request(environ))
+        registry.register(pylons.url, URLGenerator(pylons.config['routes.map'], environ))
+        registry.register(pylons.tmpl_context, ContextObj())
+        registry.register(pylons.app_globals, pylons.config['pylons.app_globals'])
+
+        routes_config = request_config()
+        routes_config.mapper = pylons.config['routes.map']
+        routes_config.environ = environ
+
+class WorkerCommand(PandaCommand):
+    summary = 'Process queued Panda notifications and transcode jobs.'
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--once',
+        action='store_true', dest='once', default=False,
+        help='Process the queue once and exit instead of polling it.')
+    parser.add_option('--interval',
+        type='int', dest='interval', default=10,
+        help='Seconds to wait between polls of the queue (default: 10).')
+    parser.add_option('--batch-size',
+        type='int', dest='batch_size', default=50,
+        help='Number of videos to process per transaction (default: 50).')
+    parser.add_option('--concurrency',
+        type='int', dest='concurrency', default=4,
+        help='Maximum number of simultaneous submissions to Panda (default: 4).')
+    parser.add_option('--rate',
+        type='float', dest='rate', default=None,
+        help='Maximum number of submissions to Panda per second (default: unlimited).')
+    parser.add_option('--capacity',
+        type='int', dest='capacity', default=2,
+        help='Number of encodings each of your Panda clouds runs in parallel (default: 2).')
+    parser.add_option('--region',
+        dest='region',
+        help='Prefer the Panda clouds in this region (e.g. us or eu) for new videos, as long as they have spare capacity.')
+    parser.add_option('--aging',
+        type='int', dest='aging', default=900,
+        help='Seconds a queued job waits before moving up one priority class (default: 900).')
+    parser.add_option('--max-attempts',
+        type='int', dest='max_attempts', default=5,
+        help='Give up on a transcode job after this many failed submissions (default: 5).')
+    parser.add_option('--retry-delay',
+        type='int', dest='retry_delay', default=60,
+        help='Seconds to wait before the first retry of a failed submission (default: 60).')
+
+    def command(self):
+        self.load_app()
+        from mediacore.model.meta import DBSession
+        from mediacoreext.simplestation.panda.lib import jobs
+        from mediacoreext.simplestation.panda.lib.clouds import panda_storages
+        from mediacoreext.simplestation.panda.lib.scheduler import Scheduler
+        from mediacoreext.simplestation.panda.lib.storage import PandaStorage
+
+        while True:
+            try:
+                # Clouds may be added or removed while the worker runs.
+                clouds = max(1, len(panda_storages()))
+                scheduler = Scheduler(self.options.capacity * clouds,
+                                      aging=self.options.aging)
+                submitted = jobs.process_transcode_jobs(scheduler,
+                    max_workers=self.options.concurrency,
+                    rate=self.options.rate,
+                    max_attempts=self.options.max_attempts,
+                    retry_delay=self.options.retry_delay,
+                    capacity=self.options.capacity,
+                    region=self.options.region)
+                if submitted:
+                    log.info('Submitted %d transcode jobs to Panda.', submitted)
+                processed = jobs.process_status_updates(
+                    batch_size=self.options.batch_size)
+                if processed:
+                    log.info('Processed %d Panda status updates.', processed)
+            except Exception, e:
+                log.exception(e)
+                DBSession.rollback()
+            DBSession.remove()
+            # Helpers are memoized per storage instance, and every pass loads
+            # a new instance.
+            PandaStorage.panda_helper.cache.clear()
+            if self.options.once:
+                break
+            time.sleep(self.options.interval)
+
+def parse_date(value):
+    return value and datetime.strptime(value, '%Y-%m-%d') or None
+
+class TranscodeCommand(PandaCommand):
+    summary = 'Transcode many existing media items with Panda.'
+    description = """Media which already have Panda renditions only get the
+missing profiles added to their existing Panda video. The jobs are queued
+with low priority and submitted to Panda by the panda-worker command.
+Progress is saved to the checkpoint file after every batch; re-running the
+command with the same checkpoint file resumes where the previous run
+stopped."""
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--base-url',
+        dest='base_url',
+        help='Public URL of this MediaCore site, used for download and notification URLs.')
+    parser.add_option('--profiles',
+        dest='profiles',
+        help='Comma-separated profile names (default: the profiles configured in the admin).')
+    parser.add_option('--media-id',
+        type='int', action='append', dest='media_ids', default=[],
+        help='Only transcode this media item. May be given several times.')
+    parser.add_option('--podcast-id',
+        type='int', dest='podcast_id',
+        help='Only transcode media in this podcast.')
+    parser.add_option('--since',
+        dest='since', help='Only transcode media created on or after this date (YYYY-MM-DD).')
+    parser.add_option('--until',
+        dest='until', help='Only transcode media created before this date (YYYY-MM-DD).')
+    parser.add_option('--priority',
+        dest='priority', default='backfill',
+        help='Priority class of the queued jobs: backfill or republish (default: backfill).')
+    parser.add_option('--batch-size',
+        type='int', dest='batch_size', default=100,
+        help='Number of media items per batch (default: 100).')
+    parser.add_option('--checkpoint',
+        dest='checkpoint', default='panda-transcode.checkpoint',
+        help='File to save progress to (default: panda-transcode.checkpoint).')
+
+    def command(self):
+        if not self.options.base_url:
+            raise BadCommand('--base-url is required.')
+        if self.options.priority not in ('backfill', 'republish'):
+            raise BadCommand('--priority must be backfill or republish.')
+        self.load_app()
+        self.setup_request(self.options.base_url)
+
+        from mediacore.lib.helpers import url_for
+        from mediacoreext.simplestation.panda.lib.bulk import (BulkTranscode,
+            Checkpoint, select_media)
+        from mediacoreext.simplestation.panda.lib.clouds import default_storage
+        from mediacoreext.simplestation.panda.lib.storage import PANDA_PROFILES
+
+        storage = default_storage()
+        if not storage:
+            raise BadCommand('Panda is not configured.')
+        if self.options.profiles:
+            profile_names = self.options.profiles.split(',')
+        else:
+            profile_names = storage._data[PANDA_PROFILES]
+
+        def state_update_url(media_file):
+            return url_for(controller='/panda/admin/media', action='panda_update',
+                           file_id=media_file.id, qualified=True)
+
+        query = select_media(
+            media_ids=self.options.media_ids,
+            podcast_id=self.options.podcast_id,
+            created_since=parse_date(self.options.since),
+            created_until=parse_date(self.options.until),
+        )
+        bulk = BulkTranscode(storage.panda_helper(), profile_names,
+            state_update_url,
+            priority=self.options.priority,
+            checkpoint=Checkpoint(self.options.checkpoint),
+            batch_size=self.options.batch_size,
+        )
+        checkpoint = bulk.run(query)
+        print '%d queued, %d skipped, %d failed.' % (
+            checkpoint.queued, checkpoint.skipped, len(checkpoint.failed))
+        for media_id, error in sorted(checkpoint.failed.items()):
+            print '  media %s: %s' % (media_id, error)
+
+class CleanupCommand(PandaCommand):
+    summary = 'Delete Panda videos and encodings no media file refers to.'
+    description = """Videos which are neither associated with a media file,
+nor the source of a rendition, nor part of a queued transcode job are deleted
+from Panda, along with failed encodings of completed videos. Use --dry-run
+to see what would be deleted first."""
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--dry-run',
+        action='store_true', dest='dry_run', default=False,
+        help='Only list what would be deleted.')
+    parser.add_option('--min-age',
+        type='int', dest='min_age', default=24,
+        help='Leave videos and encodings younger than this many hours alone (default: 24).')
+    parser.add_option('--batch-size',
+        type='int', dest='batch_size', default=50,
+        help='Number of deletions per batch (default: 50).')
+    parser.add_option('--concurrency',
+        type='int', dest='concurrency', default=4,
+        help='Maximum number of simultaneous requests to Panda (default: 4).')
+    parser.add_option('--rate',
+        type='float', dest='rate', default=2,
+        help='Maximum number of requests to Panda per second (default: 2).')
+
+    def command(self):
+        self.load_app()
+        from mediacoreext.simplestation.panda.lib.cleanup import Cleanup
+        from mediacoreext.simplestation.panda.lib.clouds import panda_storages
+
+        storages = panda_storages()
+        if not storages:
+            raise BadCommand('Panda is not configured.')
+        for storage in storages:
+            if len(storages) > 1:
+                print '%s:' % storage.display_name
+            cleanup = Cleanup(storage,
+                min_age=self.options.min_age * 3600,
+                batch_size=self.options.batch_size,
+                max_workers=self.options.concurrency,
+                rate=self.options.rate,
+            )
+            self.print_report(cleanup.run(dry_run=self.options.dry_run))
+
+    def print_report(self, report):
+        if self.options.dry_run:
+            for video_id in report['videos']:
+                print 'video %s' % video_id
+            for encoding_id in report['encodings']:
+                print 'encoding %s' % encoding_id
+            print '%d videos and %d encodings would be deleted.' % (
+                len(report['videos']), len(report['encodings']))
+            return
+        failed = report['failed']
+        print '%d videos and %d encodings deleted, %d failed.' % (
+            len([i for i in report['videos'] if i not in failed]),
+            len([i for i in report['encodings'] if i not in failed]),
+            len(failed))
+        for item_id, error in sorted(failed.items()):
+            print '  %s: %s' % (item_id, error)
+
+class ProfilesCommand(PandaCommand):
+    summary = 'Bring the encoding profiles of the Panda clouds up to date.'
+    description = """Creates the missing profiles and updates those whose
+settings differ, matching profiles by name. With --prune, profiles that are
+not in the desired set are deleted, except those selected in the settings of
+any Panda storage."""
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--set',
+        dest='sets', default='web,custom',
+        help='Comma-separated built-in profile sets: web, custom (default: web,custom).')
+    parser.add_option('--file',
+        dest='file',
+        help='JSON file with a list of profiles to use instead of the built-in sets.')
+    parser.add_option('--prune',
+        action='store_true', dest='prune', default=False,
+        help='Delete profiles that are not in the desired set.')
+    parser.add_option('--dry-run',
+        action='store_true', dest='dry_run', default=False,
+        help='Only list the changes.')
+    parser.add_option('--concurrency',
+        type='int', dest='concurrency', default=4,
+        help='Maximum number of simultaneous requests to Panda (default: 4).')
+
+    def command(self):
+        from mediacoreext.simplestation.panda.lib.profiles import (load_profiles,
+            profile_sets, reconcile_profiles)
+        if self.options.file:
+            desired = load_profiles(self.options.file)
+        else:
+            desired = []
+            for name in self.options.sets.split(','):
+                if name not in profile_sets:
+                    raise BadCommand('Unknown profile set: %s' % name)
+                desired.extend(profile_sets[name])
+        self.load_app()
+        from mediacoreext.simplestation.panda.lib.clouds import panda_storages
+        from mediacoreext.simplestation.panda.lib.jobs import transcode_jobs
+        from mediacoreext.simplestation.panda.lib.storage import (PANDA_PREVIEW_PROFILE,
+            PANDA_PROFILES)
+
+        storages = panda_storages()
+        if not storages:
+            raise BadCommand('Panda is not configured.')
+        # Every cloud must offer the same profiles, jobs can go to any of them.
+        # Queued jobs still need the profiles they were created with.
+        protected = set()
+        for storage in storages:
+            protected.update(storage._data[PANDA_PROFILES])
+            if storage._data.get(PANDA_PREVIEW_PROFILE):
+                protected.add(storage._data[PANDA_PREVIEW_PROFILE])
+        for file_id, job in transcode_jobs():
+            protected.update(job['profiles'])
+            protected.update(job.get('deferred_profiles', ()))
+        for storage in storages:
+            if len(storages) > 1:
+                print '%s:' % storage.display_name
+            plan, failed = reconcile_profiles(storage.panda_helper().client, desired,
+                prune=self.options.prune,
+                protected=protected,
+                dry_run=self.options.dry_run,
+                max_workers=self.options.concurrency,
+            )
+            for action, name, data in plan:
+                status = name in failed and ' FAILED: %s' % failed[name] or ''
+                print '%s %s%s' % (action, name, status)
+            if not plan:
+                print 'All profiles are up to date.'
@@ -5,7 +5,12 @@
 # (at your option) any later version.
 # See LICENSE.txt in the main project directory, for more information.
 
+import calendar
 import logging
+import math
+from datetime import datetime
+
+from pylons import request, response
 
 from mediacore.lib.auth import has_permission, FunctionProtector
 from mediacore.lib.base import BaseController
@@ -15,7 +20,14 @@ from mediacore.model import Media, MediaFile, fetch_row
 from mediacore.model.meta import DBSession
 
 from mediacoreext.simplestation.panda.mediacore_plugin import add_panda_vars
-from mediacoreext.simplestation.panda.lib.storage import PandaStorage
+from mediacoreext.simplestation.panda.lib import PandaException, dumps
+from mediacoreext.simplestation.panda.lib.badges import encoding_badges
+from mediacoreext.simplestation.panda.lib.bulk import bulk_cancel, bulk_retry
+from mediacoreext.simplestation.panda.lib.clouds import (panda_storages,
+    storage_for_file, storage_for_video)
+from mediacoreext.simplestation.panda.lib.jobs import files_of_video
+from mediacoreext.simplestation.panda.lib.status import (MAX_WAIT,
+    media_status, notifier, wait_for_status)
 
 log = logging.getLogger(__name__)
 admin_perms = has_permission('edit')
@@ -30,17 +42,85 @@ class MediaController(BaseController):
 
         encoding_dicts = result['encoding_dicts']
         result['display_panda_refresh_message'] = \
-            not any(encoding_dicts.get(file.id) for file in media.files)
+            not any(encoding_dicts.get(file.id) for file in media.files) \
+            and not result['transcode_jobs']
 
         return result
 
+    @FunctionProtector(admin_perms)
+    @expose()
+    def panda_status_json(self, id, since=None, wait=None, **kwargs):
+        """Return the encoding status of a media item as JSON.
+
+        The status is versioned; the version is sent as the ETag, and a
+        request with a matching If-None-Match header gets an empty
+        ``304 Not Modified`` response.
+
+        :param since: A version the client has. Only the rows that changed
+            since then are returned, if the version is still known.
+        :param wait: Seconds to hold the request while the status is still
+            at version ``since``, at most :data:`status.MAX_WAIT`. See
+            :func:`status.wait_for_status`.
+        """
+        media = fetch_row(Media, id)
+        clients = [storage.panda_helper().client for storage in panda_storages()]
+        checks = []
+        def get_status():
+            if checks:
+                # Look at the current state of Panda, without taking the
+                # cached responses away from other requests.
+                for client in clients:
+                    client.private_cache()
+            checks.append(True)
+            status = media_status(media, add_panda_vars(media=media), since)
+            # Don't hold a transaction (and a pooled connection) open while
+            # waiting. The next check sees the current state of the database.
+            DBSession.rollback()
+            return status
+        try:
+            timeout = float(wait or 0)
+        except ValueError:
+            timeout = 0
+        if math.isnan(timeout) or math.isinf(timeout):
+            timeout = 0
+        timeout = max(0, min(timeout, MAX_WAIT))
+        try:
+            status = wait_for_status(media.id, get_status, since, timeout)
+        finally:
+            for client in clients:
+                client.shared_cache()
+
+        etag = '"%s"' % status['version']
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if_none_match = request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            response.status_int = 304
+            return ''
+        response.headers['Content-Type'] = 'application/json'
+        return dumps(status)
+
+    @FunctionProtector(admin_perms)
+    @expose('json')
+    def panda_badges(self, ids='', **kwargs):
+        """Return the encoding status badges of many media items.
+
+        :param ids: Comma separated media IDs, e.g. those of a page of the
+            admin media list.
+        """
+        media_ids = [int(i) for i in ids.split(',') if i.strip().isdigit()]
+        return dict(
+            badges = encoding_badges(media_ids),
+        )
+
     @FunctionProtector(admin_perms)
     @expose('json')
     @autocommit
     def panda_cancel(self, file_id, encoding_id, **kwargs):
         media_file = fetch_row(MediaFile, file_id)
-        storage = DBSession.query(PandaStorage).first()
+        storage = storage_for_file(media_file)
         storage.panda_helper().cancel_transcode(media_file, encoding_id)
+        notifier.notify(media_file.media_id)
         return dict(
             success = True,
         )
@@ -50,27 +130,109 @@ class MediaController(BaseController):
     @autocommit
     def panda_retry(self, file_id, encoding_id, **kwargs):
         media_file = fetch_row(MediaFile, file_id)
-        storage = DBSession.query(PandaStorage).first()
+        storage = storage_for_file(media_file)
         storage.panda_helper().retry_transcode(media_file, encoding_id)
+        notifier.notify(media_file.media_id)
         return dict(
             success = True,
         )
 
+    @FunctionProtector(admin_perms)
+    @expose('json')
+    def panda_bulk_cancel(self, **kwargs):
+        """Cancel many encodings, selected by ID or a filter.
+
+        :param encoding_ids: Comma separated encoding IDs.
+        :param status: Only encodings with this status.
+        :param profile: Only encodings of this profile name.
+        :param since: Only encodings created on or after this date (YYYY-MM-DD).
+        :param until: Only encodings created before this date (YYYY-MM-DD).
+        """
+        return self._bulk_action(bulk_cancel, kwargs)
+
+    @FunctionProtector(admin_perms)
+    @expose('json')
+    @autocommit
+    def panda_bulk_retry(self, **kwargs):
+        """Retry many encodings, by default all failed ones.
+
+        Takes the same parameters as :meth:`panda_bulk_cancel`.
+        """
+        return self._bulk_action(bulk_retry, kwargs)
+
+    def _bulk_action(self, action, kwargs):
+        succeeded = []
+        failed = {}
+        media_ids = set()
+        try:
+            criteria = _bulk_criteria(kwargs)
+            storages = panda_storages()
+            for storage in storages:
+                result = action(storage.panda_helper(), **criteria)
+                succeeded.extend(result['succeeded'])
+                failed.update(result['failed'])
+                media_ids.update(result['media'])
+        except (PandaException, ValueError), e:
+            return dict(success=False, message=unicode(e))
+        for media_id in media_ids:
+            notifier.notify(media_id)
+        if len(storages) > 1:
+            # Explicitly given IDs are looked up in every cloud, but each
+            # one only exists in one of them.
+            for encoding_id in succeeded:
+                failed.pop(encoding_id, None)
+        return dict(
+            success = not failed,
+            succeeded = succeeded,
+            failed = failed,
+        )
+
     @expose()
     @autocommit
     def panda_update(self, media_id=None, file_id=None, video_id=None, **kwargs):
+        storages = panda_storages()
+
         if file_id:
+            # A state_update notification from Panda. Acknowledge it right
+            # away and leave the actual work to the panda-worker command.
             media_file = fetch_row(MediaFile, file_id)
+            storage = storage_for_file(media_file, storages)
             media_files = [media_file]
-        elif media_id:
-            media = fetch_row(Media, media_id)
-            media_files = media.files
-
-        storage = DBSession.query(PandaStorage).first()
+            if video_id:
+                # Panda notifies the file a video was uploaded for, also
+                # about profiles added later for uploads of the same content
+                # (see jobs.reuse_encoded_video). So flag every file the
+                # video is associated with.
+                media_files = files_of_video(video_id) or media_files
+                storage = storage_for_video(video_id, storages)
+            for f in media_files:
+                storage.panda_helper().queue_status_update(f, video_id)
+            # Wake the status boxes waiting for news about this media.
+            for media_id in set(f.media_id for f in media_files):
+                notifier.notify(media_id)
+            return u'OK'
 
-        for media_file in media_files:
+        media = fetch_row(Media, media_id)
+        for media_file in media.files:
+            storage = storage_for_file(media_file, storages)
             storage.panda_helper().video_status_update(media_file, video_id)
 
-        media_files[0].media.update_status()
+        media.update_status()
 
         redirect(controller='/admin/media', action='edit', id=media_id)
+
+def _bulk_criteria(kwargs):
+    def timestamp(value):
+        if not value:
+            return None
+        dt = datetime.strptime(value, '%Y-%m-%d')
+        return calendar.timegm(dt.timetuple())
+    encoding_ids = [i.strip() for i in kwargs.get('encoding_ids', '').split(',')
+                    if i.strip()]
+    return dict(
+        encoding_ids = encoding_ids or None,
+        status = kwargs.get('status') or None,
+        profile_name = kwargs.get('profile') or None,
+        created_since = timestamp(kwargs.get('since')),
+        created_until = timestamp(kwargs.get('until')),
+    )
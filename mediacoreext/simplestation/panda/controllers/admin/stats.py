@@ -0,0 +1,62 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+import logging
+import time
+
+from mediacore.lib.auth import has_permission, FunctionProtector
+from mediacore.lib.base import BaseController
+from mediacore.lib.decorators import expose
+from mediacore.model import Media, fetch_row
+
+from mediacoreext.simplestation.panda.mediacore_plugin import add_panda_vars
+from mediacoreext.simplestation.panda.lib.hosts import host_report
+from mediacoreext.simplestation.panda.lib.stats import (load_samples,
+    profile_report)
+
+log = logging.getLogger(__name__)
+admin_perms = has_permission('edit')
+
+class StatsController(BaseController):
+    @FunctionProtector(admin_perms)
+    @expose('panda/admin/stats.html')
+    def index(self, days=30, **kwargs):
+        """Display encoding throughput figures per profile."""
+        days = int(days)
+        return dict(
+            days = days,
+            report = self._report(days),
+        )
+
+    @FunctionProtector(admin_perms)
+    @expose('json')
+    def report(self, days=30, **kwargs):
+        """Return the encoding throughput figures per profile as JSON.
+
+        Also includes the response times and error rates of the Panda API
+        hosts, as seen by this process.
+        """
+        days = int(days)
+        return dict(
+            days = days,
+            profiles = self._report(days),
+            api_hosts = host_report(),
+        )
+
+    @FunctionProtector(admin_perms)
+    @expose('json')
+    def eta(self, id, **kwargs):
+        """Return the estimated seconds left for the media's unfinished encodings."""
+        media = fetch_row(Media, id)
+        result = add_panda_vars(media=media)
+        return dict(
+            etas = result['encoding_etas'],
+        )
+
+    def _report(self, days):
+        since = days and time.time() - days * 86400 or None
+        return profile_report(load_samples(since))
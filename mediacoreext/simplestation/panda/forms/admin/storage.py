@@ -17,7 +17,8 @@ from mediacore.model.meta import DBSession
 from mediacoreext.simplestation.panda.lib import PandaException
 from mediacoreext.simplestation.panda.lib.storage import (CLOUDFRONT_DOWNLOAD_URI,
     CLOUDFRONT_STREAMING_URI, PANDA_ACCESS_KEY, PANDA_CLOUD_ID, PANDA_PROFILES,
-    PANDA_SECRET_KEY, PANDA_API_HOST, S3_BUCKET_NAME)
+    PANDA_PREVIEW_PROFILE, PANDA_SECRET_KEY, PANDA_API_HOST,
+    PANDA_FALLBACK_API_HOSTS, S3_BUCKET_NAME)
 
 
 class ProfileCheckBoxList(CheckBoxList):
@@ -34,6 +35,9 @@ class PandaForm(StorageForm):
             TextField('secret_key', maxlength=255, label_text=N_('Secret Key', domain='mediacore_panda')),
             SingleSelectField('api_host', label_text=N_('API URL', domain='mediacore_panda'),
                 options=('api.pandastream.com', 'api-eu.pandastream.com')),
+            TextField('fallback_api_hosts', maxlength=255,
+                label_text=N_('Fallback API hosts', domain='mediacore_panda'),
+                help_text=N_('Optional. Comma separated hosts which serve this cloud too. They are used when the API URL above is slow or unreachable.', domain='mediacore_panda')),
         ]),
         ListFieldSet('s3', suppress_label=True, legend=N_('Amazon S3 Details:', domain='mediacore_panda'), children=[
             TextField('bucket_name', maxlength=255, label_text=N_('S3 Bucket Name', domain='mediacore_panda')),
@@ -47,6 +51,9 @@ class PandaForm(StorageForm):
             TextField('download_uri', maxlength=255, label_text=N_('CloudFront Download Domain', domain='mediacore_panda')),
         ]),
         ProfileCheckBoxList('profiles', label_text=N_('Encodings to use', domain='mediacore_panda')),
+        TextField('preview_profile', maxlength=255,
+            label_text=N_('Preview encoding', domain='mediacore_panda'),
+            help_text=N_('Optional. The name of a fast, low resolution profile of this cloud which is encoded and published first. The other encodings follow once it is done.', domain='mediacore_panda')),
     ] + StorageForm.buttons
 
     def display(self, value, engine, **kwargs):
@@ -67,6 +74,8 @@ class PandaForm(StorageForm):
                 'access_key': engine._data[PANDA_ACCESS_KEY],
                 'secret_key': engine._data[PANDA_SECRET_KEY],
                 'api_host': engine._data.get(PANDA_API_HOST),
+                'fallback_api_hosts': u', '.join(
+                    engine._data.get(PANDA_FALLBACK_API_HOSTS, [])),
             },
             's3': {
                 'bucket_name': engine._data[S3_BUCKET_NAME],
@@ -76,6 +85,7 @@ class PandaForm(StorageForm):
                 'download_uri': engine._data[CLOUDFRONT_DOWNLOAD_URI],
             },
             'profiles': engine._data[PANDA_PROFILES],
+            'preview_profile': engine._data.get(PANDA_PREVIEW_PROFILE, u''),
         }, value)
 
         merged_kwargs = {}
@@ -89,7 +99,8 @@ class PandaForm(StorageForm):
         # kwargs are vars for the template, value is a dict of values for the form.
         return StorageForm.display(self, merged_value, engine, **merged_kwargs)
 
-    def save_engine_params(self, engine, panda, s3, cloudfront, profiles, **kwargs):
+    def save_engine_params(self, engine, panda, s3, cloudfront, profiles,
+                           preview_profile=None, **kwargs):
         """Map validated field values to engine data.
 
         Since form widgets may be nested or named differently than the keys
@@ -114,15 +125,26 @@ class PandaForm(StorageForm):
         engine._data[PANDA_ACCESS_KEY] = panda['access_key']
         engine._data[PANDA_SECRET_KEY] = panda['secret_key']
         engine._data[PANDA_API_HOST] = panda['api_host']
+        engine._data[PANDA_FALLBACK_API_HOSTS] = [host.strip() for host
+            in panda['fallback_api_hosts'].split(',') if host.strip()]
         engine._data[PANDA_PROFILES] = profiles
+        engine._data[PANDA_PREVIEW_PROFILE] = (preview_profile or u'').strip()
         engine._data[S3_BUCKET_NAME] = s3['bucket_name']
         engine._data[CLOUDFRONT_STREAMING_URI] = cloudfront['streaming_uri']
         engine._data[CLOUDFRONT_DOWNLOAD_URI] = cloudfront['download_uri']
 
         engine.panda_helper.cache.clear()
         try:
-            engine.panda_helper().client.get_cloud()
+            client = engine.panda_helper().client
+            client.get_cloud()
+            profile_names = [p['name'] for p in client.get_profiles()]
         except PandaException, e:
             DBSession.rollback()
             # TODO: Display this error to the user.
             raise Invalid(str(e), None, None)
+
+        preview_profile = engine._data[PANDA_PREVIEW_PROFILE]
+        if preview_profile and preview_profile not in profile_names:
+            DBSession.rollback()
+            raise Invalid('The preview encoding %r is not a profile of this '
+                          'Panda cloud.' % preview_profile, None, None)
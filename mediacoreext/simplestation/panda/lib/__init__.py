@@ -5,14 +5,16 @@
 # (at your option) any later version.
 # See LICENSE.txt in the main project directory, for more information.
 
+import httplib
 import logging
 import os
-import simplejson
+import socket
+import threading
+import time
 import urllib
+import zlib
 from pprint import pformat
-from socket import gaierror
 
-import panda
 from pylons import request
 
 from mediacore.lib.helpers import download_uri
@@ -20,20 +22,76 @@ from mediacore.lib.storage import add_new_media_file
 from mediacore.model.meta import DBSession
 from mediacore.model.media import MediaFilesMeta
 
+from mediacoreext.simplestation.panda.lib import streaming
+from mediacoreext.simplestation.panda.lib.hosts import host_health, rank_hosts
+from mediacoreext.simplestation.panda.lib.profiler import record_call
+
 log = logging.getLogger(__name__)
 
-# Monkeypatch panda.urlescape as per http://github.com/newbamboo/panda_client_python/commit/43e9d613bfe34ae09f2815bf026e5a5f5f0abd0a
 def urlescape(s):
     s = unicode(s)
     return urllib.quote(s).replace("%7E", "~").replace(' ', '%20').replace('/', '%2F')
-panda.urlescape = urlescape
+
+_panda = None
+
+def panda_module():
+    """Import the Panda client library on first use.
+
+    Importing ``panda`` is deferred until a client actually talks to Panda so
+    that processes which merely load the plugin (workers, paster commands)
+    don't pay for it.
+    """
+    global _panda
+    if _panda is None:
+        import panda
+        # Monkeypatch panda.urlescape as per http://github.com/newbamboo/panda_client_python/commit/43e9d613bfe34ae09f2815bf026e5a5f5f0abd0a
+        panda.urlescape = urlescape
+        _panda = panda
+    return _panda
 
 PUT = 'PUT'
 POST = 'POST'
 DELETE = 'DELETE'
 GET = 'GET'
 
+REQUEST_TIMEOUT = 30
+"""Seconds after which a Panda API host that doesn't respond counts as failed."""
+
 META_VIDEO_PREFIX = u"panda_video_"
+# Values stored in the association meta row for a MediaFile/Video pairing.
+# A notification from Panda flags the pairing, the worker clears the flag.
+STATE_UPDATE_PENDING = u"update_pending"
+# Meta key on the source MediaFile for a transcode that still has to be sent
+# to Panda. See :meth:`PandaHelper.queue_transcode`.
+META_TRANSCODE_JOB = u"panda_transcode_job"
+JOB_PENDING = 'pending'
+JOB_SUBMITTED = 'submitted'
+JOB_FAILED = 'failed'
+# Priority classes of transcode jobs, most urgent first. See :mod:`scheduler`.
+PRIORITY_UPLOAD = 'upload'
+PRIORITY_REPUBLISH = 'republish'
+PRIORITY_BACKFILL = 'backfill'
+PRIORITIES = [PRIORITY_UPLOAD, PRIORITY_REPUBLISH, PRIORITY_BACKFILL]
+# Meta key on MediaFiles created from Panda encodings, pointing back at the
+# Panda video they belong to.
+META_RENDITION_VIDEO = u"panda_rendition_of"
+ORIGINAL_DISPLAY_PREFIX = u"(original) "
+# Meta keys on a source MediaFile: the SHA-1 of its content and, once its
+# transcode has completed, the Panda video holding the renditions.
+# See :mod:`fingerprint`.
+META_FINGERPRINT = u"panda_fingerprint"
+META_FINGERPRINT_VIDEO = u"panda_fingerprint_video"
+# Meta key on MediaFiles created from Panda encodings, holding the encoding's
+# timing and size figures. See :mod:`stats`.
+META_ENCODING_STATS = u"panda_encoding_stats"
+# Meta key prefix, followed by a Panda video ID, on the MediaFile the video
+# was submitted for. The value is the ID of the PandaStorage (i.e. cloud)
+# the video lives in. See :mod:`clouds`.
+META_CLOUD_PREFIX = u"panda_cloud_"
+stats_keys = [
+    'profile_id', 'created_at', 'started_encoding_at', 'encoding_time',
+    'file_size', 'duration', 'width', 'height',
+]
 PANDA_URL_PREFIX = "panda:"
 TYPES = {
     'video': "video_id",
@@ -42,7 +100,7 @@ TYPES = {
     'url': "url",
 }
 
-# TODO: Use these lists to verify that all received data has a valid structure.
+# The fields kept of the data received from Panda, see Record.
 cloud_keys = [
     'id', 'created_at', 'updated_at', # Common
     'name', 's3_private_access', 's3_videos_bucket', # Cloud-specific
@@ -50,91 +108,413 @@ cloud_keys = [
 profile_keys = [
     'id', 'extname', 'created_at', 'updated_at', 'height', 'width', # Common
     'title', 'name', 'preset_name', # Profile-specific
+    'command', 'audio_bitrate', 'video_bitrate',
 ]
 video_keys = [
     'id', 'extname', 'created_at', 'updated_at', 'height', 'width', # Common
     'file_size', 'status', # Video/Encoding specific
     'source_url', 'original_filename', 'audio_codec', 'video_codec', 'duration', 'fps', # Video Specific
+    'audio_bitrate', 'video_bitrate',
 ]
 encoding_keys = [
     'id', 'extname', 'created_at', 'updated_at', 'height', 'width', # Common
     'file_size', 'status', # Video/Encoding Specific
-    'encoding_progress', 'encoding_time', 'started_encoding_at', 'profile_id', 'video_id', # Encoding Specific
+    'encoding_progress', 'encoding_time', 'started_encoding_at', 'profile_id', 'video_id', 'duration', # Encoding Specific
+    'audio_bitrate', 'video_bitrate',
 ]
+numeric_keys = frozenset([
+    'height', 'width', 'file_size', 'duration', 'encoding_progress',
+    'encoding_time', 'audio_bitrate', 'video_bitrate',
+])
+
+NOT_FOUND = 'RecordNotFound'
+"""The error Panda reports for a video, encoding or profile that doesn't exist."""
 
 class PandaException(Exception):
-    pass
+    def not_found(self):
+        """Whether Panda answered that the requested object doesn't exist.
 
-def log_request(request_url, method, query_string_data, body_data, response_data):
-    log.debug("Sending Panda a %s request: %s from %s", method, request_url, request.url)
+        Errors talking to Panda at all, like timeouts, are not.
+        """
+        return bool(self.args) and self.args[0] == NOT_FOUND
+
+class Record(object):
+    """A Panda object, decoded from its JSON representation.
+
+    Only the fields named in ``__slots__`` are kept, which takes a fraction
+    of the memory of the dict they are decoded from. Fields Panda didn't
+    send are None. Records support the read-only parts of the mapping
+    protocol, so they can be used wherever the plain dicts were used.
+
+    :raises PandaException: If ``data`` isn't a dict with an ID, or a
+        numeric field holds something else.
+    """
+    __slots__ = ()
+
+    def __init__(self, data):
+        if not isinstance(data, dict) or not data.get('id'):
+            raise PandaException('Malformed Panda %s.' % self.__class__.__name__.lower(), data)
+        for key in self.__slots__:
+            value = data.get(key)
+            if key in numeric_keys and value is not None \
+            and not isinstance(value, (int, long, float)):
+                raise PandaException('Malformed Panda %s: %s is not a number.'
+                                     % (self.__class__.__name__.lower(), key), data)
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def iteritems(self):
+        for key in self.__slots__:
+            yield key, getattr(self, key)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.id)
+
+    @classmethod
+    def decode(cls, obj):
+        """Turn a decoded JSON object, or a list of them, into records."""
+        if isinstance(obj, list):
+            return [cls(x) for x in obj]
+        return cls(obj)
+
+class Cloud(Record):
+    __slots__ = tuple(cloud_keys)
+
+class Profile(Record):
+    __slots__ = tuple(profile_keys)
+
+class Video(Record):
+    __slots__ = tuple(video_keys)
+
+class Encoding(Record):
+    __slots__ = tuple(encoding_keys)
+
+def loads(s):
+    import simplejson
+    return simplejson.loads(s)
+
+def dumps(obj):
+    import simplejson
+    return simplejson.dumps(obj, default=_record_to_dict)
+
+def _record_to_dict(obj):
+    if isinstance(obj, Record):
+        return dict(obj.iteritems())
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def log_request(request_url, method, query_string_data, body_data, response_data,
+                host=None):
+    try:
+        source = request.url
+    except TypeError:
+        # Not called from within a web request, e.g. by the worker command.
+        source = None
+    log.debug("Sending Panda a %s request: %s%s from %s", method,
+              host or '', request_url, source)
     if query_string_data:
         log.debug("Query String Data: %s", pformat(query_string_data))
     if body_data:
         log.debug("Request Body Data: %s", pformat(body_data))
     log.debug("Received response: %s", pformat(response_data))
 
+def _error_response(response):
+    """Return the error object of a Panda response that isn't a success.
+
+    :raises ValueError: If the body isn't a Panda error, e.g. the error
+        page of a proxy in front of an unhealthy host.
+    """
+    body = response.read()
+    if response.getheader('content-encoding', '').lower() == 'gzip':
+        body = ''.join(streaming.gunzip([body]))
+    obj = loads(body)
+    if not isinstance(obj, dict) or 'error' not in obj:
+        raise ValueError('HTTP status %d from Panda.' % response.status)
+    return obj
+
 class PandaClient(object):
-    def __init__(self, cloud_id, access_key, secret_key, api_host=None):
+    def __init__(self, cloud_id, access_key, secret_key, api_host=None,
+                 fallback_hosts=(), timeout=REQUEST_TIMEOUT):
         if api_host:
             api_host = api_host.encode('utf-8')
         else:
             api_host = 'api.pandastream.com'
-        self.conn = panda.Panda(
-            cloud_id.encode('utf-8'),
-            access_key.encode('utf-8'),
-            secret_key.encode('utf-8'),
-            api_host=api_host,
-        )
+        self.cloud_id = cloud_id.encode('utf-8')
+        self.access_key = access_key.encode('utf-8')
+        self.secret_key = secret_key.encode('utf-8')
+        self.api_host = api_host
+        # All hosts must serve the cloud, see the hosts module.
+        self.hosts = [api_host] + [h.encode('utf-8') for h in fallback_hosts
+                                   if h and h.encode('utf-8') != api_host]
+        self.timeout = timeout
+        self._conns = {}
         self.json_cache = {}
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """The connection to the configured API host."""
+        return self.conn_for(self.api_host)
+
+    def conn_for(self, host):
+        # Connections are only built once the first request is made.
+        # Requests are signed for the host, so each needs its own.
+        if host not in self._conns:
+            self._conns[host] = panda_module().Panda(
+                self.cloud_id,
+                self.access_key,
+                self.secret_key,
+                api_host=host,
+            )
+        return self._conns[host]
+
+    def clear_cache(self):
+        """Forget all memoized GET responses."""
+        self.json_cache.clear()
+
+    def private_cache(self):
+        """Memoize the current thread's GET responses in a new, empty cache.
+
+        Unlike :meth:`clear_cache`, this leaves the responses other threads
+        share untouched. Call :meth:`shared_cache` to return to those.
+        """
+        self._local.json_cache = {}
+
+    def shared_cache(self):
+        """Undo :meth:`private_cache` for the current thread."""
+        self._local.__dict__.pop('json_cache', None)
+
+    @property
+    def _cache(self):
+        return getattr(self._local, 'json_cache', self.json_cache)
 
-    def _get_json(self, url, query_string_data={}):
+    def _open(self, host, method, url, params, headers=None):
+        """Send a signed request to a host, return the connection and response.
+
+        The request is signed by the client library, but sent over our own
+        connection: the library's has no timeout, so a host that stops
+        answering would block the request forever.
+        """
+        panda = panda_module()
+        conn = self.conn_for(host)
+        path = panda.canonical_path(url)
+        query = panda.dict2query(conn.signed_params(method, path, params))
+        headers = dict(headers or {})
+        target = conn.api_path() + path
+        body = None
+        if method in (POST, PUT):
+            body = query
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        else:
+            target += '?' + query
+        http = httplib.HTTPConnection(host, getattr(conn, 'api_port', 80),
+                                      timeout=self.timeout)
+        try:
+            http.request(method, target, body, headers)
+            return http, http.getresponse()
+        except:
+            http.close()
+            raise
+
+    def _request(self, method, url, params, failover=False):
+        """Send a request to the best API host and decode the response.
+
+        A response that can't be decoded (e.g. an error page of a proxy)
+        counts as a failure of the host, just like a connection error or a
+        host not answering within :attr:`timeout` seconds.
+
+        :param failover: Try the other hosts if the best one fails.
+        :returns: The decoded JSON object.
+        :raises PandaException: If Panda answered with an error object, or
+            if no host could be asked.
+        """
+        hosts = rank_hosts(self.hosts)
+        if not failover:
+            hosts = hosts[:1]
+        for host in hosts:
+            started = time.time()
+            try:
+                if self.can_sign:
+                    http, response = self._open(host, method, url, params)
+                    try:
+                        json = response.read()
+                    finally:
+                        http.close()
+                else:
+                    conn = self.conn_for(host)
+                    json = getattr(conn, method.lower())(request_path=url, params=params)
+                obj = loads(json)
+            except (socket.error, httplib.HTTPException, ValueError), e:
+                # Catch socket errors and re-raise them as Panda errors.
+                host_health(host).record(time.time() - started, False)
+                log.warn('Panda API host %s failed: %s', host, e)
+                error = e
+                continue
+            host_health(host).record(time.time() - started, True)
+            record_call(method, url, params, started, size=len(json), host=host)
+            if method in (POST, PUT):
+                log_request(url, method, None, params, obj, host)
+            else:
+                log_request(url, method, params, None, obj, host)
+            if 'error' in obj:
+                raise PandaException(obj['error'], obj['message'])
+            return obj
+        raise PandaException(error)
+
+    def _get_json(self, url, query_string_data={}, record=None, stream=False):
         # This function is memoized with a custom hashing algorithm for its arguments.
+        # Responses are cached as Records if a record class is given.
+        started = time.time()
         hash_tuple = url, frozenset(query_string_data.iteritems())
-        if hash_tuple in self.json_cache:
-            return self.json_cache[hash_tuple]
+        cache = self._cache
+        if hash_tuple in cache:
+            record_call(GET, url, query_string_data, started, cached=True)
+            return cache[hash_tuple]
+
+        if stream and self.can_sign:
+            obj = list(self._stream_json(url, query_string_data, record))
+            cache[hash_tuple] = obj
+            return obj
+
+        obj = self._request(GET, url, query_string_data, failover=True)
+        if record is not None:
+            obj = record.decode(obj)
+        cache[hash_tuple] = obj
+        return obj
 
-        try:
-            json = self.conn.get(request_path=url, params=query_string_data)
-        except gaierror, e:
-            # Catch socket errors and re-raise them as Panda errors.
-            raise PandaException(e)
-
-        obj = simplejson.loads(json)
-        log_request(url, GET, query_string_data, None, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
+    @property
+    def can_sign(self):
+        # Streaming and timeouts need the request signing of the panda client
+        # library, versions without it fall back to its own requests.
+        return hasattr(self.conn, 'signed_params')
 
-        self.json_cache[hash_tuple] = obj
-        return obj
+    def _iter_json(self, url, query_string_data={}, record=None):
+        """Iterate over a listing without keeping all of it in memory.
 
-    def _post_json(self, url, post_data={}):
-        json = self.conn.post(request_path=url, params=post_data)
-        obj = simplejson.loads(json)
-        log_request(url, POST, None, post_data, obj)
-        if 'error' in obj:
+        Cached responses are reused, but a streamed response isn't cached.
+        """
+        hash_tuple = url, frozenset(query_string_data.iteritems())
+        if hash_tuple in self._cache or not self.can_sign:
+            return iter(self._get_json(url, query_string_data, record))
+        return self._stream_json(url, query_string_data, record)
+
+    def _stream_json(self, url, query_string_data={}, record=None):
+        # Sign and send the request ourselves: the client library only
+        # returns the complete response body, and doesn't ask for gzip.
+        # Other hosts are only tried as long as nothing has been read.
+        for host in rank_hosts(self.hosts):
+            started = time.time()
+            http = None
+            try:
+                http, response = self._open(host, GET, url, query_string_data,
+                                            {'Accept-Encoding': 'gzip'})
+                if 200 <= response.status < 300:
+                    # Only the time to the response headers is comparable.
+                    host_health(host).record(time.time() - started, True)
+                    break
+                obj = _error_response(response)
+            except (socket.error, httplib.HTTPException, ValueError, zlib.error), e:
+                if http is not None:
+                    http.close()
+                host_health(host).record(time.time() - started, False)
+                log.warn('Panda API host %s failed: %s', host, e)
+                error = e
+                continue
+            # An error reported by Panda itself, the host is fine.
+            http.close()
+            host_health(host).record(time.time() - started, True)
+            record_call(GET, url, query_string_data, started, host=host)
+            log_request(url, GET, query_string_data, None, obj, host)
             raise PandaException(obj['error'], obj['message'])
+        else:
+            raise PandaException(error)
+
+        size = [0]
+        try:
+            log_request(url, GET, query_string_data, None, '(streamed)', host)
+
+            def count(chunks):
+                for chunk in chunks:
+                    size[0] += len(chunk)
+                    yield chunk
+            chunks = count(streaming.read_chunks(response))
+            if response.getheader('content-encoding', '').lower() == 'gzip':
+                chunks = streaming.gunzip(chunks)
+            try:
+                for text in streaming.split_array(chunks):
+                    obj = loads(text)
+                    if record is not None:
+                        obj = record(obj)
+                    yield obj
+            except streaming.NotAnArray, e:
+                try:
+                    obj = loads(e.text)
+                except ValueError:
+                    obj = None
+                if isinstance(obj, dict) and 'error' in obj:
+                    raise PandaException(obj['error'], obj['message'])
+                host_health(host).record(time.time() - started, False)
+                raise PandaException('Expected a list from Panda.', url)
+            except (socket.error, httplib.HTTPException, ValueError, zlib.error), e:
+                # Part of the listing has been handed out already, so it
+                # can't be fetched from another host instead.
+                host_health(host).record(time.time() - started, False)
+                log.warn('Panda API host %s failed: %s', host, e)
+                raise PandaException(e)
+        finally:
+            http.close()
+            # The size is that of the (compressed) response body.
+            record_call(GET, url, query_string_data, started, size=size[0],
+                        host=host)
+
+    def _post_json(self, url, post_data={}, record=None):
+        obj = self._request(POST, url, post_data)
+        if record is not None:
+            obj = record.decode(obj)
         return obj
 
-    def _put_json(self, url, put_data={}):
-        json = self.conn.put(request_path=url, params=put_data)
-        obj = simplejson.loads(json)
-        log_request(url, PUT, None, put_data, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
+    def _put_json(self, url, put_data={}, record=None):
+        obj = self._request(PUT, url, put_data)
+        if record is not None:
+            obj = record.decode(obj)
         return obj
 
     def _delete_json(self, url, query_string_data={}):
-        json = self.conn.delete(request_path=url, params=query_string_data)
-        obj = simplejson.loads(json)
-        log_request(url, DELETE, query_string_data, None, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
-        return obj
+        return self._request(DELETE, url, query_string_data)
 
     def get_cloud(self):
         """Get the data for the currently selected Panda cloud."""
-        url = '/clouds/%s.json' % self.conn.cloud_id
-        return self._get_json(url)
+        url = '/clouds/%s.json' % self.cloud_id
+        return self._get_json(url, record=Cloud)
 
     def get_presets(self):
         """Get the configuration options for the existing encoding presets in this cloud."""
@@ -152,7 +532,19 @@ class PandaClient(object):
         data = {}
         if status in ('success', 'fail', 'processing'):
             data['status'] = status
-        return self._get_json('/videos.json', data)
+        return self._get_json('/videos.json', data, record=Video, stream=True)
+
+    def iter_videos(self, status=None):
+        """Like :meth:`get_videos`, but decode the videos one at a time.
+
+        Use this for going through all videos of a large cloud once.
+
+        :rtype: iterator of :class:`Video`
+        """
+        data = {}
+        if status in ('success', 'fail', 'processing'):
+            data['status'] = status
+        return self._iter_json('/videos.json', data, record=Video)
 
     def get_encodings(self, status=None, profile_id=None, profile_name=None, video_id=None):
         """List all encoded instances of all videos, filtered by whatever critera are provided.
@@ -180,14 +572,30 @@ class PandaClient(object):
             data['profile_name'] = profile_name
         if video_id:
             data['video_id'] = video_id
-        return self._get_json('/encodings.json', data)
+        return self._get_json('/encodings.json', data, record=Encoding, stream=True)
+
+    def iter_encodings(self, status=None, profile_id=None, profile_name=None, video_id=None):
+        """Like :meth:`get_encodings`, but decode the encodings one at a time.
+
+        :rtype: iterator of :class:`Encoding`
+        """
+        data = {}
+        if status in ('success', 'fail', 'processing'):
+            data['status'] = status
+        if profile_id:
+            data['profile_id'] = profile_id
+        if profile_name:
+            data['profile_name'] = profile_name
+        if video_id:
+            data['video_id'] = video_id
+        return self._iter_json('/encodings.json', data, record=Encoding)
 
     def get_profiles(self):
         """List all encoding profiles.
 
         :rtype: list of dicts
         """
-        return self._get_json('/profiles.json')
+        return self._get_json('/profiles.json', record=Profile)
 
     def get_video(self, video_id):
         """Get the details for a single video.
@@ -198,7 +606,7 @@ class PandaClient(object):
         :rtype: dict
         """
         url = '/videos/%s.json' % video_id
-        return self._get_json(url)
+        return self._get_json(url, record=Video)
 
     def get_encoding(self, encoding_id):
         """Get the details for a single encoding of a video.
@@ -209,7 +617,7 @@ class PandaClient(object):
         :rtype: dict
         """
         url = '/encodings/%s.json' % encoding_id
-        return self._get_json(url)
+        return self._get_json(url, record=Encoding)
 
     def get_profile(self, profile_id):
         """Get the details for a single encoding profile.
@@ -220,7 +628,7 @@ class PandaClient(object):
         :rtype: dict
         """
         url = '/profiles/%s.json' % profile_id
-        return self._get_json(url)
+        return self._get_json(url, record=Profile)
 
     def add_profile(self, title, extname, width, height, command, name=None):
         """Add a profile using the settings provided.
@@ -255,7 +663,7 @@ class PandaClient(object):
         )
         if not name:
             data.pop('name')
-        return self._post_json('/profiles.json', data)
+        return self._post_json('/profiles.json', data, record=Profile)
 
     def add_profile_from_preset(self, preset_name, name=None, width=None, height=None):
         """Add a profile based on the provided preset, extending with the settings provided.
@@ -278,10 +686,25 @@ class PandaClient(object):
             width = width,
             height = height
         )
-        for x in data:
+        for x in data.keys():
             if data[x] == None:
                 data.pop(x)
-        return self._post_json('/profiles.json', data)
+        return self._post_json('/profiles.json', data, record=Profile)
+
+    def update_profile(self, profile_id, **kwargs):
+        """Change the settings of an existing profile.
+
+        :param profile_id: The ID string of the profile.
+        :type profile_id: str
+
+        Takes the same keyword arguments as :meth:`add_profile` and
+        :meth:`add_profile_from_preset`; only those given are changed.
+
+        :returns: a dict representing the updated profile object
+        :rtype: dict
+        """
+        url = '/profiles/%s.json' % profile_id
+        return self._put_json(url, kwargs, record=Profile)
 
     def delete_encoding(self, encoding_id):
         """Delete the reference to a particular encoding from the Panda servers.
@@ -348,7 +771,7 @@ class PandaClient(object):
         }
         if state_update_url:
             data['state_update_url'] = state_update_url
-        return self._post_json('/videos.json', data)
+        return self._post_json('/videos.json', data, record=Video)
 
     def add_transcode_profile(self, video_id, profile_id):
         """Add a transcode profile to an existing Panda video.
@@ -366,13 +789,16 @@ class PandaClient(object):
             'video_id': video_id,
             'profile_id': profile_id,
         }
-        return self._post_json('/encodings.json', data)
+        return self._post_json('/encodings.json', data, record=Encoding)
 
 
 class PandaHelper(object):
-    def __init__(self, cloud_id, access_key, secret_key, api_host=None):
+    def __init__(self, cloud_id, access_key, secret_key, api_host=None,
+                 storage_id=None, fallback_api_hosts=()):
         self.client = PandaClient(cloud_id, access_key, secret_key,
-                                  api_host=api_host)
+                                  api_host=api_host,
+                                  fallback_hosts=fallback_api_hosts)
+        self.storage_id = storage_id
 
     def profile_names_to_ids(self, names):
         profiles = self.client.get_profiles()
@@ -402,6 +828,10 @@ class PandaHelper(object):
         # This is sort of a perversion of the meta table, but hey, it works.
         meta_key = u"%s%s" % (META_VIDEO_PREFIX, video_id)
         media_file.meta[meta_key] = state
+        if self.storage_id is not None:
+            # Remember which cloud the video lives in, for good.
+            cloud_key = u"%s%s" % (META_CLOUD_PREFIX, video_id)
+            media_file.meta[cloud_key] = unicode(self.storage_id)
 
     def disassociate_video_id(self, media_file, video_id):
         # Create a meta_key for this MediaCore::MediaFile -> Panda::Video pairing.
@@ -413,6 +843,25 @@ class PandaHelper(object):
         for x in mfm:
             DBSession.delete(x)
 
+    def queue_status_update(self, media_file, video_id=None):
+        """Flag the given video (or all associated videos) for a status update.
+
+        The actual work is done later by :func:`jobs.process_status_updates`.
+        Flagging the same pairing repeatedly is harmless, so duplicate
+        notifications from Panda collapse into a single update.
+
+        :returns: The list of video IDs that were flagged.
+        """
+        video_ids = self.list_associated_video_ids(media_file)
+        if video_id is not None:
+            if video_id not in video_ids:
+                # Already processed, or not ours to begin with.
+                return []
+            video_ids = [video_id]
+        for id in video_ids:
+            self.associate_video_id(media_file, id, state=STATE_UPDATE_PENDING)
+        return video_ids
+
     def list_associated_video_ids(self, media_file):
         # This method returns a list, for futureproofing and testing, but the
         # current logic basically ensures that the list will have at most one element.
@@ -478,6 +927,95 @@ class PandaHelper(object):
         else:
             raise PandaException('Could not delete specified encoding.', encoding_id)
 
+    def queue_transcode(self, media_file, profile_ids, state_update_url=None,
+                        priority=PRIORITY_UPLOAD, source=None,
+                        deferred_profiles=None):
+        """Record a transcode job to be submitted to Panda by the worker.
+
+        The job is stored with the MediaFile, so it is committed (or rolled
+        back) together with the upload itself.
+
+        :param source: A dict with the source's width, height and bitrate,
+            used to skip profiles that wouldn't add any value. See
+            :func:`ladder.select_profiles`.
+        :param deferred_profiles: Profiles to add only once the encodings of
+            ``profile_ids`` are done. Renditions are then attached one by one
+            as they finish instead of all at once.
+        """
+        uri = download_uri(media_file)
+        if not uri:
+            raise PandaException('Cannot transcode because no download URL exists.')
+        self._queue_job(media_file, priority, profile_ids,
+            uri=str(uri),
+            state_update_url=state_update_url,
+            source=source or {},
+            deferred_profiles=deferred_profiles or [],
+            incremental=bool(deferred_profiles),
+        )
+
+    def queue_add_profiles(self, media_file, video_id, profile_names,
+                           priority=PRIORITY_BACKFILL, incremental=False,
+                           failed_encodings=None):
+        """Record a job adding the missing profiles to an existing Panda video.
+
+        Which of the given profiles are actually missing is only determined
+        when the worker submits the job. New renditions will be attached to
+        ``media_file``'s media.
+
+        :param incremental: Attach each rendition as soon as it is done.
+        :param failed_encodings: IDs of the video's encodings that already
+            failed and must not keep the job from completing.
+        """
+        self._queue_job(media_file, priority, profile_names,
+                        video_id=video_id, incremental=incremental,
+                        failed_encodings=list(failed_encodings or ()))
+
+    def _queue_job(self, media_file, priority, profiles, **kwargs):
+        job = {
+            'status': JOB_PENDING,
+            'priority': priority,
+            'profiles': list(profiles),
+            'attempts': 0,
+            'error': None,
+            'created': time.time(),
+            'next_attempt': time.time(),
+        }
+        job.update(kwargs)
+        self.set_transcode_job(media_file, job)
+
+    def get_transcode_job(self, media_file):
+        value = media_file.meta.get(META_TRANSCODE_JOB)
+        if not value:
+            return None
+        return loads(value)
+
+    def set_transcode_job(self, media_file, job):
+        media_file.meta[META_TRANSCODE_JOB] = unicode(dumps(job))
+
+    def clear_transcode_job(self, media_file):
+        mfm = DBSession.query(MediaFilesMeta)\
+                .filter(MediaFilesMeta.media_files_id==media_file.id)\
+                .filter(MediaFilesMeta.key==META_TRANSCODE_JOB)
+        for x in mfm:
+            DBSession.delete(x)
+
+    def find_panda_video_id(self, media):
+        """Return the ID of the Panda video whose renditions belong to this media.
+
+        :rtype: str or None
+        """
+        for file in media.files:
+            video_id = file.meta.get(META_RENDITION_VIDEO)
+            if video_id:
+                return video_id
+        # Renditions created by older versions of this plugin only carry the
+        # video ID in the unique_id of the original file.
+        for file in media.files:
+            if file.storage.engine_type == u'PandaStorage' \
+            and file.display_name.startswith(ORIGINAL_DISPLAY_PREFIX):
+                return os.path.splitext(file.unique_id)[0]
+        return None
+
     def transcode_media_file(self, media_file, profile_ids, state_update_url=None):
         uri = download_uri(media_file)
         if not uri:
@@ -486,37 +1024,123 @@ class PandaHelper(object):
         self.associate_video_id(media_file, transcode_details['id'])
 
     def video_status_update(self, media_file, video_id=None):
+        """Create MediaFiles for the encodings of a completed Panda video.
+
+        If the preview of an upload that is encoded in stages fails, the
+        rest of its ladder is queued anyway; the failed encodings no longer
+        hold up the video.
+
+        :returns: True if nothing is left to do for the given video(s), False
+            if some are still being encoded.
+        """
         # If no ID is specified, update all associated videos!
         if video_id is None:
             video_ids = self.list_associated_video_ids(media_file)
+            done = True
             for video_id in video_ids:
-                self.video_status_update(media_file, video_id)
-            return
+                done = self.video_status_update(media_file, video_id) and done
+            return done
+
+        # A repeated notification for a video that was already materialized
+        # must not create its renditions a second time.
+        if video_id not in self.list_associated_video_ids(media_file):
+            return True
 
         v = self.client.get_video(video_id)
         encodings = self.client.get_encodings(video_id=video_id)
+        job = self.get_transcode_job(media_file)
+        if job and job.get('video_id') != video_id:
+            job = None
+
+        successful = [e for e in encodings if e['status'] == 'success']
+        failed = set(job and job.get('failed_encodings') or ())
+        unfinished = [e for e in encodings
+                      if e['status'] != 'success' and e['id'] not in failed]
 
         # Only proceed if the video has completed all encoding steps successfully.
-        if any(e['status'] != 'success' for e in encodings):
-            return
+        if unfinished:
+            if job and job.get('incremental'):
+                # Attach whatever is ready already.
+                self.record_encoding_stats(self.create_renditions(media_file, v,
+                    successful))
+            if not (job and job.get('deferred_profiles')) \
+            or any(e['status'] != 'fail' for e in unfinished):
+                return False
+            # The preview failed. Encode the rest of the ladder anyway and
+            # leave the failed encodings to be retried, see bulk.bulk_retry.
+            log.warn('Preview encodings %s of Panda video %s failed.',
+                     ', '.join(e['id'] for e in unfinished), video_id)
+            failed.update(e['id'] for e in unfinished)
+
+        self.record_encoding_stats(self.create_renditions(media_file, v, successful))
+
+        self.disassociate_video_id(media_file, v['id'])
+        if job and job.get('deferred_profiles'):
+            # The preview is done, now encode the rest of the ladder.
+            self.queue_add_profiles(media_file, v['id'], job['deferred_profiles'],
+                priority=job.get('priority', PRIORITY_UPLOAD), incremental=True,
+                failed_encodings=sorted(failed))
+        elif job:
+            # The job is no longer in flight.
+            self.clear_transcode_job(media_file)
+        if media_file.meta.get(META_FINGERPRINT):
+            # Make this video available to later uploads of the same content.
+            media_file.meta[META_FINGERPRINT_VIDEO] = v['id']
+        # TODO: Now delete the exisitng media_file?
+        return True
 
+    def create_renditions(self, media_file, video, encodings):
+        """Create MediaFiles for a Panda video and its encodings.
+
+        The new MediaFiles are added to ``media_file``'s media and named
+        after it. Renditions the media already has are skipped.
+
+        :returns: A list of ``(media_file, encoding)`` tuples for the
+            renditions created from encodings.
+        """
+        created = []
         profiles = self.get_profile_ids_names()
+        existing_ids = set(f.unique_id for f in media_file.media.files)
 
         # For each successful encoding (and the original file), create a new MediaFile
         display_name, orig_ext = os.path.splitext(media_file.display_name)
-        v['display_name'] = "(%s) %s%s" % ('original', display_name, v['extname'])
-        url = PANDA_URL_PREFIX + simplejson.dumps(v)
-        new_mf = add_new_media_file(media_file.media, url=url)
+        if display_name.startswith(ORIGINAL_DISPLAY_PREFIX):
+            # Profiles were added to an existing Panda video.
+            display_name = display_name[len(ORIGINAL_DISPLAY_PREFIX):]
+        v = dict(video)
+        v['display_name'] = "%s%s%s" % (ORIGINAL_DISPLAY_PREFIX, display_name, v['extname'])
+        # Tells PandaStorage.parse which cloud's storage the files belong to.
+        v['cloud_id'] = self.client.cloud_id
+        if v['id'] + v['extname'] not in existing_ids:
+            url = PANDA_URL_PREFIX + dumps(v)
+            new_mf = add_new_media_file(media_file.media, url=url)
+            new_mf.meta[META_RENDITION_VIDEO] = v['id']
 
         for e in encodings:
+            e = dict(e)
+            e['cloud_id'] = self.client.cloud_id
             # Panda reports multi-bitrate http streaming encodings as .ts file
             # but the associated playlist is the only thing ipods, etc, can read.
             if e['extname'] == '.ts':
                 e['extname'] = '.m3u8'
+            if e['id'] + e['extname'] in existing_ids:
+                continue
 
-            e['display_name'] = "(%s) %s%s" % (profiles[e['profile_id']].replace('_', ' '), display_name, e['extname'])
-            url = PANDA_URL_PREFIX + simplejson.dumps(e)
+            e['display_name'] = "(%s) %s%s" % (profiles.get(e['profile_id'], e['profile_id']).replace('_', ' '), display_name, e['extname'])
+            url = PANDA_URL_PREFIX + dumps(e)
             new_mf = add_new_media_file(media_file.media, url=url)
+            new_mf.meta[META_RENDITION_VIDEO] = v['id']
+            created.append((new_mf, e))
+        return created
 
-        self.disassociate_video_id(media_file, v['id'])
-        # TODO: Now delete the exisitng media_file?
+    def record_encoding_stats(self, renditions):
+        """Store the timing and size figures of newly encoded renditions.
+
+        :param renditions: ``(media_file, encoding)`` tuples as returned by
+            :meth:`create_renditions`.
+        """
+        profiles = self.get_profile_ids_names()
+        for media_file, e in renditions:
+            stats = dict((key, e.get(key)) for key in stats_keys)
+            stats['profile'] = profiles.get(e['profile_id'])
+            media_file.meta[META_ENCODING_STATS] = unicode(dumps(stats))
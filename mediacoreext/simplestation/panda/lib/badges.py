@@ -0,0 +1,205 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Encoding status badges for a whole page of the admin media list.
+
+Asking Panda about every associated video of every listed media item would
+take a request per video. Instead, :func:`encoding_badges` reads the
+associations and transcode jobs of all the media in one query, and asks
+each cloud that has any of their videos for its processing and failed
+encodings and its failed videos, once. Those listings are kept for
+:data:`BADGE_TTL` seconds (:class:`ActivityCache`), so paging through the
+list costs two queries per page and a few Panda requests per cloud and
+minute.
+
+A badge is one of ``failed``, ``encoding`` (with the average progress),
+``queued``, or ``finishing`` (Panda is done, the ``panda-worker`` hasn't
+created the renditions yet). Media without anything going on get none.
+"""
+
+import logging
+import threading
+import time
+
+from sqlalchemy import or_
+
+from mediacore.model import MediaFile
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (JOB_FAILED, JOB_SUBMITTED,
+    META_CLOUD_PREFIX, META_TRANSCODE_JOB, META_VIDEO_PREFIX, PandaException,
+    loads)
+from mediacoreext.simplestation.panda.lib.clouds import panda_storages
+
+log = logging.getLogger(__name__)
+
+BADGE_TTL = 30
+"""Seconds for which the Panda listings of a cloud are reused."""
+
+MAX_MEDIA = 200
+"""The most media items badges are computed for at once."""
+
+def media_associations(media_ids):
+    """Return the Panda videos and transcode jobs of many media items.
+
+    This is a single query, regardless of the number of media and files.
+
+    :returns: A dict mapping media IDs to dicts with the ``videos`` (a dict
+        mapping the associated video IDs to the ID of their storage engine,
+        or None if unknown) and the transcode ``jobs``.
+    """
+    result = {}
+    if not media_ids:
+        return result
+    rows = DBSession.query(MediaFile.media_id, MediaFilesMeta.key,
+                           MediaFilesMeta.value)\
+        .filter(MediaFilesMeta.media_files_id == MediaFile.id)\
+        .filter(MediaFile.media_id.in_(media_ids))\
+        .filter(or_(MediaFilesMeta.key.startswith(META_VIDEO_PREFIX),
+                    MediaFilesMeta.key.startswith(META_CLOUD_PREFIX),
+                    MediaFilesMeta.key == META_TRANSCODE_JOB))
+    clouds = {}
+    for media_id, key, value in rows:
+        media = result.setdefault(media_id, {'videos': {}, 'jobs': []})
+        if key == META_TRANSCODE_JOB:
+            media['jobs'].append(loads(value))
+        elif key.startswith(META_VIDEO_PREFIX):
+            media['videos'].setdefault(key[len(META_VIDEO_PREFIX):], None)
+        else:
+            clouds[key[len(META_CLOUD_PREFIX):]] = value
+    for media in result.itervalues():
+        for video_id in media['videos']:
+            media['videos'][video_id] = clouds.get(video_id)
+    return result
+
+class CloudActivity(object):
+    """What a cloud is working on, as far as the badges are concerned.
+
+    :attr processing: A dict mapping video IDs to a list of ``(progress,
+        started)`` tuples of their unfinished encodings.
+    :attr failed: The IDs of videos that failed or have failed encodings.
+    """
+    __slots__ = ('processing', 'failed', 'expires')
+
+    def __init__(self, helper):
+        client = helper.client
+        self.processing = {}
+        for e in client.iter_encodings(status='processing'):
+            self.processing.setdefault(e['video_id'], []).append(
+                (e['encoding_progress'] or 0, bool(e['started_encoding_at'])))
+        self.failed = set(e['video_id'] for e in client.iter_encodings(status='fail'))
+        self.failed.update(v['id'] for v in client.iter_videos(status='fail'))
+        self.expires = time.time() + BADGE_TTL
+
+class ActivityCache(object):
+    """The :class:`CloudActivity` of each cloud, by storage engine ID.
+
+    Panda is asked without holding the lock, by one request per cloud at a
+    time. Other requests meanwhile make do with the expired activity, if
+    there is one.
+    """
+    def __init__(self):
+        self.activities = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, storage):
+        """Return the activity of a storage engine's cloud, or None if unknown."""
+        self.lock.acquire()
+        try:
+            activity = self.activities.get(storage.id)
+            if activity is not None and activity.expires > time.time() \
+            or storage.id in self.refreshing:
+                return activity
+            self.refreshing.add(storage.id)
+        finally:
+            self.lock.release()
+
+        activity = None
+        try:
+            try:
+                activity = CloudActivity(storage.panda_helper())
+            except PandaException, e:
+                log.warn('Could not fetch the encodings of Panda storage %s: %s',
+                         storage.id, e)
+        finally:
+            self.lock.acquire()
+            try:
+                if activity is not None:
+                    self.activities[storage.id] = activity
+                self.refreshing.discard(storage.id)
+            finally:
+                self.lock.release()
+        return activity
+
+cache = ActivityCache()
+
+def badge(videos, jobs, activities):
+    """Return the badge of a media item, or None.
+
+    :param videos: A dict mapping video IDs to storage engine IDs.
+    :param jobs: The media's transcode jobs.
+    :param activities: A dict mapping storage engine IDs to their
+        :class:`CloudActivity`, or None if that is unknown.
+    """
+    if [job for job in jobs if job['status'] == JOB_FAILED]:
+        return {'status': 'failed'}
+    # Submitted jobs show up as encodings.
+    jobs = [job for job in jobs if job['status'] != JOB_SUBMITTED]
+    encodings = []
+    unknown = False
+    for video_id, storage_id in videos.iteritems():
+        activity = activities.get(storage_id)
+        if activity is None:
+            unknown = True
+            continue
+        if video_id in activity.failed:
+            return {'status': 'failed'}
+        encodings.extend(activity.processing.get(video_id, []))
+    if [started for progress, started in encodings if started]:
+        progress = sum(progress for progress, started in encodings) / len(encodings)
+        return {'status': 'encoding', 'progress': int(progress),
+                'count': len(encodings)}
+    if encodings or jobs:
+        return {'status': 'queued', 'count': len(encodings) or None}
+    if unknown:
+        return {'status': 'encoding', 'progress': None, 'count': None}
+    if videos:
+        return {'status': 'finishing'}
+    return None
+
+def encoding_badges(media_ids):
+    """Return the badges of the given media items, by media ID.
+
+    Media without a badge are left out.
+    """
+    associations = media_associations(list(media_ids)[:MAX_MEDIA])
+    if not associations:
+        return {}
+    storages = panda_storages()
+    if not storages:
+        return {}
+    # Videos without a recorded cloud belong to the first one.
+    default_id = unicode(storages[0].id)
+    for media in associations.itervalues():
+        for video_id, storage_id in media['videos'].items():
+            media['videos'][video_id] = storage_id or default_id
+
+    wanted = set(storage_id for media in associations.itervalues()
+                 for storage_id in media['videos'].itervalues())
+    activities = {}
+    for storage in storages:
+        if unicode(storage.id) in wanted:
+            activities[unicode(storage.id)] = cache.get(storage)
+
+    badges = {}
+    for media_id, media in associations.iteritems():
+        b = badge(media['videos'], media['jobs'], activities)
+        if b is not None:
+            badges[media_id] = b
+    return badges
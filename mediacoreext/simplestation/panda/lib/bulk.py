@@ -0,0 +1,344 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""(Re)transcoding of many existing media items, and cancelling or retrying
+many encodings, at once.
+
+Media which already have Panda renditions only get the missing profiles
+added to their existing Panda video (see
+:meth:`PandaClient.add_transcode_profile`), so their sources are not
+uploaded to Panda again. All other media have their source file submitted
+as a new video.
+
+The work is queued as low priority transcode jobs; the ``panda-worker``
+command submits them to Panda as the :mod:`scheduler` allows, with its
+request rate and concurrency limits.
+"""
+
+import logging
+import os
+import time
+
+from mediacore.lib.filetypes import VIDEO
+from mediacore.model import Media, MediaFile
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (JOB_PENDING, JOB_SUBMITTED,
+    META_VIDEO_PREFIX, PRIORITY_BACKFILL, PRIORITY_REPUBLISH, PandaException,
+    dumps, loads)
+from mediacoreext.simplestation.panda.lib.stats import parse_time
+from mediacoreext.simplestation.panda.lib.threads import map_concurrently
+
+log = logging.getLogger(__name__)
+
+class Checkpoint(object):
+    """Progress of a bulk run, persisted to a JSON file after every batch."""
+    def __init__(self, path=None):
+        self.path = path
+        self.last_media_id = 0
+        self.queued = 0
+        self.skipped = 0
+        self.failed = {}
+        if path and os.path.exists(path):
+            f = open(path)
+            try:
+                data = loads(f.read())
+            finally:
+                f.close()
+            self.last_media_id = data['last_media_id']
+            self.queued = data['queued']
+            self.skipped = data['skipped']
+            self.failed = data['failed']
+
+    def save(self):
+        if not self.path:
+            return
+        data = dumps({
+            'last_media_id': self.last_media_id,
+            'queued': self.queued,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        })
+        # Write to a temporary file first so an interrupted run can't leave
+        # a truncated checkpoint behind.
+        tmp_path = self.path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+def select_media(media_ids=None, podcast_id=None, created_since=None,
+                 created_until=None):
+    """Return a query for the media to transcode, ordered by ID.
+
+    :param media_ids: Only include these media IDs.
+    :param podcast_id: Only include media in this podcast.
+    :param created_since: Only include media created on or after this datetime.
+    :param created_until: Only include media created before this datetime.
+    """
+    query = DBSession.query(Media).filter(Media.type == VIDEO)
+    if media_ids:
+        query = query.filter(Media.id.in_(media_ids))
+    if podcast_id:
+        query = query.filter(Media.podcast_id == podcast_id)
+    if created_since:
+        query = query.filter(Media.created_on >= created_since)
+    if created_until:
+        query = query.filter(Media.created_on < created_until)
+    return query.order_by(Media.id)
+
+class BulkTranscode(object):
+    """Queue the media selected by a query for transcoding.
+
+    :param helper: The :class:`PandaHelper` for the target cloud.
+    :param profile_names: The profiles every selected media should have.
+    :param state_update_url: A callable returning the notification URL for a
+        given source MediaFile.
+    :param priority: The priority class of the queued jobs.
+    :param checkpoint: A :class:`Checkpoint`; media up to and including its
+        ``last_media_id`` are skipped.
+    :param batch_size: Number of media to queue (and commit) at once.
+    """
+    def __init__(self, helper, profile_names, state_update_url,
+                 priority=PRIORITY_BACKFILL, checkpoint=None, batch_size=100):
+        self.helper = helper
+        self.profile_names = profile_names
+        self.state_update_url = state_update_url
+        self.priority = priority
+        self.checkpoint = checkpoint or Checkpoint()
+        self.batch_size = batch_size
+
+    def queue(self, media):
+        """Queue a transcode job for the given media, if needed.
+
+        :returns: True if a job was queued.
+        """
+        helper = self.helper
+        for file in media.files:
+            if helper.list_associated_video_ids(file) \
+            or helper.get_transcode_job(file):
+                # Already on its way through Panda.
+                return False
+
+        video_id = helper.find_panda_video_id(media)
+        if video_id:
+            helper.queue_add_profiles(self._association_file(media), video_id,
+                self.profile_names, priority=self.priority)
+            return True
+
+        for file in media.files:
+            if file.type != VIDEO or file.storage.engine_type == u'PandaStorage':
+                continue
+            try:
+                helper.queue_transcode(file, self.profile_names,
+                    state_update_url=self.state_update_url(file),
+                    priority=self.priority)
+            except PandaException:
+                # No download URL, try the next file.
+                continue
+            return True
+        return False
+
+    def _association_file(self, media):
+        # New renditions are named after the original upload if it is still
+        # around, otherwise after the Panda original.
+        for file in media.files:
+            if file.type == VIDEO and file.storage.engine_type != u'PandaStorage':
+                return file
+        for file in media.files:
+            if file.storage.engine_type == u'PandaStorage':
+                return file
+
+    def run(self, query):
+        """Queue all media selected by ``query``, resuming from the checkpoint.
+
+        :returns: The :class:`Checkpoint` with the final counts.
+        """
+        checkpoint = self.checkpoint
+        while True:
+            batch = query.filter(Media.id > checkpoint.last_media_id)\
+                .limit(self.batch_size).all()
+            if not batch:
+                break
+            for media in batch:
+                try:
+                    if self.queue(media):
+                        checkpoint.queued += 1
+                    else:
+                        checkpoint.skipped += 1
+                except Exception, e:
+                    log.exception(e)
+                    checkpoint.failed[str(media.id)] = unicode(e)
+            DBSession.commit()
+            checkpoint.last_media_id = batch[-1].id
+            checkpoint.save()
+            log.info('Bulk transcode: up to media %d, %d queued, %d skipped, %d failed.',
+                     checkpoint.last_media_id, checkpoint.queued,
+                     checkpoint.skipped, len(checkpoint.failed))
+        return checkpoint
+
+def associated_videos():
+    """Return a dict mapping the IDs of all associated Panda videos to file IDs.
+
+    This is a single query, regardless of the number of associations.
+    """
+    offset = len(META_VIDEO_PREFIX)
+    rows = DBSession.query(MediaFilesMeta.media_files_id, MediaFilesMeta.key)\
+        .filter(MediaFilesMeta.key.startswith(META_VIDEO_PREFIX))
+    return dict((key[offset:], file_id) for file_id, key in rows)
+
+def find_encodings(helper, encoding_ids=None, status=None, profile_name=None,
+                   created_since=None, created_until=None, max_workers=4):
+    """Fetch the encodings selected by IDs or a filter.
+
+    :param encoding_ids: Fetch exactly these encodings. The other criteria
+        are still applied.
+    :param status: One of 'success', 'fail', 'processing'.
+    :param profile_name: Only encodings of this profile.
+    :param created_since: Only encodings created at or after this many
+        seconds since the epoch.
+    :param created_until: Only encodings created before this time.
+    :returns: A tuple of the list of encoding dicts and a dict mapping IDs
+        that couldn't be fetched to error messages.
+    """
+    errors = {}
+    if encoding_ids:
+        encodings = []
+        results = map_concurrently(helper.client.get_encoding, encoding_ids, max_workers)
+        for encoding_id, encoding, error in results:
+            if error is None:
+                encodings.append(encoding)
+            else:
+                errors[encoding_id] = unicode(error)
+    elif status or profile_name or created_since or created_until:
+        encodings = helper.client.iter_encodings(status=status,
+                                                 profile_name=profile_name)
+    else:
+        raise PandaException('Refusing to select all encodings, provide IDs or a filter.')
+
+    profile_ids = profile_name and helper.profile_names_to_ids([profile_name])
+    selected = []
+    for e in encodings:
+        created = parse_time(e['created_at'])
+        if status and e['status'] != status \
+        or profile_ids and e['profile_id'] not in profile_ids \
+        or created_since and (created is None or created < created_since) \
+        or created_until and (created is None or created >= created_until):
+            continue
+        selected.append(e)
+    return selected, errors
+
+def _bulk_encoding_action(helper, action, max_workers, check=None, **criteria):
+    encodings, failed = find_encodings(helper, max_workers=max_workers, **criteria)
+
+    # Only touch encodings of videos associated with one of our files.
+    owners = associated_videos()
+    owned = []
+    for e in encodings:
+        if e['video_id'] not in owners:
+            failed[e['id']] = u'Encoding is not associated with any media file.'
+            continue
+        # ``check`` may veto an encoding before anything is done to it.
+        error = check and check(e, owners[e['video_id']])
+        if error:
+            failed[e['id']] = error
+        else:
+            owned.append(e)
+
+    succeeded = []
+    for e, result, error in map_concurrently(action, owned, max_workers):
+        if error is None:
+            succeeded.append(e)
+        else:
+            failed[e['id']] = unicode(error)
+    return {'succeeded': succeeded, 'failed': failed, 'owners': owners}
+
+def _media_ids(file_ids):
+    if not file_ids:
+        return []
+    rows = DBSession.query(MediaFile.media_id)\
+        .filter(MediaFile.id.in_(list(file_ids))).distinct()
+    return [media_id for (media_id,) in rows]
+
+def bulk_cancel(helper, max_workers=4, **criteria):
+    """Cancel many encodings at once.
+
+    Takes the same criteria as :func:`find_encodings`. Encodings which don't
+    belong to any of our media files are left alone.
+
+    :returns: A dict with the list of ``succeeded`` encoding IDs, a dict of
+        ``failed`` encoding IDs with their error messages, and the IDs of
+        the affected ``media``.
+    """
+    def cancel(e):
+        if not helper.client.delete_encoding(e['id']):
+            raise PandaException('Could not delete specified encoding.', e['id'])
+    result = _bulk_encoding_action(helper, cancel, max_workers, **criteria)
+    owners = result.pop('owners')
+    result['media'] = _media_ids(set(owners[e['video_id']]
+                                     for e in result['succeeded']))
+    result['succeeded'] = [e['id'] for e in result['succeeded']]
+    return result
+
+def bulk_retry(helper, max_workers=4, **criteria):
+    """Retry many encodings at once, by default all failed ones.
+
+    The encodings are deleted right away. Encoding them again is queued as
+    a republish job per video, which the ``panda-worker`` submits as the
+    :mod:`scheduler` allows. See :func:`bulk_cancel`.
+
+    If the video already has a job, the profiles are added to it: a job
+    that is still waiting is submitted with them, one that is under way
+    queues them once it is done. Encodings whose file has a job for some
+    other video are left alone.
+    """
+    if not criteria.get('encoding_ids') and not criteria.get('status'):
+        criteria['status'] = 'fail'
+    jobs = {}
+    def check(e, file_id):
+        if file_id not in jobs:
+            jobs[file_id] = helper.get_transcode_job(
+                DBSession.query(MediaFile).get(file_id))
+        job = jobs[file_id]
+        if job and job.get('video_id') != e['video_id']:
+            return u'MediaFile %s has another transcode job.' % file_id
+    def delete(e):
+        if not helper.client.delete_encoding(e['id']):
+            raise PandaException('Could not delete specified encoding.', e['id'])
+    result = _bulk_encoding_action(helper, delete, max_workers, check=check,
+                                   **criteria)
+    owners = result.pop('owners')
+
+    by_video = {}
+    for e in result['succeeded']:
+        by_video.setdefault(e['video_id'], []).append(e)
+    for video_id, encodings in by_video.iteritems():
+        media_file = DBSession.query(MediaFile).get(owners[video_id])
+        names = helper.profile_ids_to_names([e['profile_id'] for e in encodings])
+        job = jobs[media_file.id]
+        if not job:
+            helper.queue_add_profiles(media_file, video_id, names,
+                                      priority=PRIORITY_REPUBLISH)
+            continue
+        if job['status'] == JOB_SUBMITTED:
+            # Leave the job alone while Panda works on it.
+            key = 'deferred_profiles'
+        else:
+            key = 'profiles'
+            job.update(status=JOB_PENDING, attempts=0, error=None,
+                       next_attempt=time.time())
+            if job['priority'] == PRIORITY_BACKFILL:
+                job['priority'] = PRIORITY_REPUBLISH
+        job[key] = job.get(key, []) + [n for n in names if n not in job.get(key, [])]
+        helper.set_transcode_job(media_file, job)
+
+    result['media'] = _media_ids(set(owners[video_id] for video_id in by_video))
+    result['succeeded'] = [e['id'] for e in result['succeeded']]
+    return result
@@ -0,0 +1,172 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Remove Panda videos and encodings that nothing refers to anymore.
+
+Deleting a media item in MediaCore, or cancelling an upload, leaves its
+Panda video behind, and so do failed encodings of completed videos. All of
+them keep showing up in every listing of the cloud.
+
+A Panda video is still in use if any of these refer to it:
+
+- an association with a MediaFile (:data:`META_VIDEO_PREFIX`),
+- a transcode job (which may add profiles to it later),
+- a rendition, either through :data:`META_RENDITION_VIDEO` or, for files
+  created before that key existed, through its ``unique_id`` (which is the
+  ID of the video or one of its encodings).
+
+Everything else older than ``min_age`` is deleted. The fingerprint index
+(:mod:`fingerprint`) alone doesn't keep a video around; its entries are
+removed along with the video. Failed encodings of videos which are no longer
+associated with a file can't be retried from the admin anymore and are
+deleted as well.
+"""
+
+import logging
+import os
+import time
+
+from mediacore.model import MediaFile
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (META_RENDITION_VIDEO,
+    META_TRANSCODE_JOB, META_VIDEO_PREFIX, loads)
+from mediacoreext.simplestation.panda.lib.fingerprint import forget_video
+from mediacoreext.simplestation.panda.lib.stats import parse_time
+from mediacoreext.simplestation.panda.lib.threads import (RateLimiter,
+    map_concurrently)
+
+log = logging.getLogger(__name__)
+
+def referenced_ids(storage):
+    """Return the set of Panda video and encoding IDs still in use.
+
+    :param storage: The :class:`PandaStorage` the renditions belong to.
+    :returns: A tuple of the set of referenced IDs and the set of video IDs
+        associated with a file.
+    """
+    offset = len(META_VIDEO_PREFIX)
+    associated = set()
+    referenced = set()
+    rows = DBSession.query(MediaFilesMeta.key, MediaFilesMeta.value)\
+        .filter((MediaFilesMeta.key.startswith(META_VIDEO_PREFIX))
+                | (MediaFilesMeta.key == META_RENDITION_VIDEO)
+                | (MediaFilesMeta.key == META_TRANSCODE_JOB))
+    for key, value in rows:
+        if key == META_RENDITION_VIDEO:
+            referenced.add(value)
+        elif key == META_TRANSCODE_JOB:
+            video_id = loads(value).get('video_id')
+            if video_id:
+                referenced.add(video_id)
+        else:
+            associated.add(key[offset:])
+    referenced.update(associated)
+
+    unique_ids = DBSession.query(MediaFile.unique_id)\
+        .filter(MediaFile.storage_id == storage.id)
+    for unique_id, in unique_ids:
+        referenced.add(os.path.splitext(unique_id)[0])
+    return referenced, associated
+
+class Cleanup(object):
+    """Find and delete unreferenced Panda videos and encodings.
+
+    :param storage: The :class:`PandaStorage` to clean up.
+    :param min_age: Leave videos and encodings younger than this many
+        seconds alone, as their MediaFile may not have been saved yet.
+    :param batch_size: Number of deletions per batch; the fingerprint index
+        is committed after every batch.
+    :param max_workers: Maximum number of simultaneous requests to Panda.
+    :param rate: Maximum number of requests to Panda per second, or None.
+    """
+    def __init__(self, storage, min_age=24*3600, batch_size=50, max_workers=4,
+                 rate=None):
+        self.storage = storage
+        self.helper = storage.panda_helper()
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate)
+
+    def find_garbage(self, now=None):
+        """Return the unreferenced videos and encodings.
+
+        :returns: A tuple of a list of video dicts and a list of encoding
+            dicts. The encodings don't include those of the listed videos,
+            which go away with their video.
+        """
+        if now is None:
+            now = time.time()
+        referenced, associated = referenced_ids(self.storage)
+        client = self.helper.client
+
+        def old_enough(d):
+            created = parse_time(d['created_at'])
+            return created is not None and now - created >= self.min_age
+
+        # The listings cover the whole cloud, so only keep what's needed.
+        in_use = set(referenced)
+        failed = []
+        for e in client.iter_encodings():
+            if e['id'] in referenced:
+                in_use.add(e['video_id'])
+            if e['status'] == 'fail':
+                failed.append(e)
+
+        dead_videos = [v for v in client.iter_videos()
+                       if v['id'] not in in_use and old_enough(v)]
+        dead_encodings = [e for e in failed
+                          if e['video_id'] in in_use
+                          and e['video_id'] not in associated
+                          and e['id'] not in referenced
+                          and old_enough(e)]
+        return dead_videos, dead_encodings
+
+    def run(self, dry_run=False):
+        """Delete everything :meth:`find_garbage` finds.
+
+        :param dry_run: Only report what would be deleted.
+        :returns: A dict with the lists of ``videos`` and ``encodings`` that
+            were (or would be) deleted, and a dict of ``failed`` IDs with
+            their error messages.
+        """
+        videos, encodings = self.find_garbage()
+        report = {
+            'videos': [v['id'] for v in videos],
+            'encodings': [e['id'] for e in encodings],
+            'failed': {},
+        }
+        if dry_run:
+            return report
+
+        client = self.helper.client
+        def delete_video(video_id):
+            self.limiter.wait()
+            return client.delete_video(video_id)
+        def delete_encoding(encoding_id):
+            self.limiter.wait()
+            return client.delete_encoding(encoding_id)
+
+        for ids, delete in ((report['videos'], delete_video),
+                            (report['encodings'], delete_encoding)):
+            for start in range(0, len(ids), self.batch_size):
+                batch = ids[start:start+self.batch_size]
+                results = map_concurrently(delete, batch, self.max_workers)
+                for item_id, deleted, error in results:
+                    if error is None and not deleted:
+                        error = u'Panda refused to delete it.'
+                    if error is not None:
+                        report['failed'][item_id] = unicode(error)
+                    elif delete is delete_video:
+                        forget_video(item_id)
+                DBSession.commit()
+                log.info('Panda cleanup: processed %d of %d items, %d failed.',
+                         start + len(batch), len(ids), len(report['failed']))
+        self.helper.client.clear_cache()
+        return report
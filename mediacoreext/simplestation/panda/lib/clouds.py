@@ -0,0 +1,115 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Spread transcodes over several Panda clouds.
+
+Every Panda cloud is configured as a :class:`PandaStorage` engine of its
+own. Uploads are queued without a cloud (see :mod:`jobs`); only when the
+worker submits a job does it pick the cloud, by region and by the number of
+encodings each cloud has in flight (:func:`pick_storage`).
+
+From then on the cloud is recorded per video in a
+:data:`META_CLOUD_PREFIX` meta row on the MediaFile it was submitted for, so
+status updates, cancellations and retries go to the cloud that has the
+video. Renditions carry the ID of their cloud, so that only that cloud's
+storage engine (and S3 bucket) accepts them in :meth:`PandaStorage.parse`.
+
+Videos submitted before there was more than one cloud have no such row and
+belong to the first cloud (:func:`default_storage`). All clouds should have
+the same profiles, see the ``panda-profiles`` command.
+"""
+
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (JOB_SUBMITTED,
+    META_CLOUD_PREFIX, META_VIDEO_PREFIX)
+from mediacoreext.simplestation.panda.lib.storage import (PANDA_API_HOST,
+    PandaStorage)
+
+def panda_storages():
+    """Return all Panda storage engines, i.e. clouds, the oldest first."""
+    return DBSession.query(PandaStorage).order_by(PandaStorage.id).all()
+
+def default_storage():
+    """Return the first Panda storage engine, or None if there is none."""
+    return DBSession.query(PandaStorage).order_by(PandaStorage.id).first()
+
+def storage_for_video(video_id, storages=None):
+    """Return the Panda storage engine whose cloud has the given video.
+
+    :param storages: The list of candidates, to save a query per call.
+    """
+    row = DBSession.query(MediaFilesMeta.value)\
+        .filter(MediaFilesMeta.key == META_CLOUD_PREFIX + video_id)\
+        .first()
+    if storages is None:
+        storages = panda_storages()
+    if row:
+        for storage in storages:
+            if unicode(storage.id) == row[0]:
+                return storage
+    return storages and storages[0] or None
+
+def storage_for_file(media_file, storages=None):
+    """Return the Panda storage engine for the videos associated with a file.
+
+    A file is associated with at most one video at a time.
+    """
+    if storages is None:
+        storages = panda_storages()
+    offset = len(META_VIDEO_PREFIX)
+    for key in media_file.meta:
+        if key.startswith(META_VIDEO_PREFIX):
+            cloud = media_file.meta.get(META_CLOUD_PREFIX + key[offset:])
+            for storage in storages:
+                if unicode(storage.id) == cloud:
+                    return storage
+    return storages and storages[0] or None
+
+def region(storage):
+    """Return the region of a storage engine's cloud, e.g. 'us' or 'eu'."""
+    host = storage._data.get(PANDA_API_HOST) or 'api.pandastream.com'
+    if host.startswith('api-') and host.endswith('.pandastream.com'):
+        return host[len('api-'):-len('.pandastream.com')]
+    return 'us'
+
+def cloud_load(jobs):
+    """Count the encodings submitted but not completed, per storage ID.
+
+    :param jobs: An iterable of job dicts.
+    """
+    load = {}
+    for job in jobs:
+        if job['status'] == JOB_SUBMITTED and job.get('cloud') is not None:
+            load[job['cloud']] = load.get(job['cloud'], 0) + job['encodings']
+    return load
+
+def pick_storage(storages, load, capacity=None, preferred_region=None):
+    """Choose the cloud a new video should be submitted to.
+
+    Clouds in ``preferred_region`` are used while they have spare capacity,
+    otherwise the least busy enabled cloud is picked.
+
+    :param storages: The candidate :class:`PandaStorage` engines.
+    :param load: A dict mapping storage IDs to in-flight encodings, as
+        returned by :func:`cloud_load`. It is updated by the caller.
+    :param capacity: The number of encodings each cloud runs in parallel.
+    :param preferred_region: A region as returned by :func:`region`.
+    :returns: A :class:`PandaStorage`, or None if no cloud is enabled.
+    """
+    candidates = [s for s in storages if s.enabled]
+    if not candidates:
+        return None
+    def busy(storage):
+        return load.get(storage.id, 0)
+    if preferred_region:
+        local = [s for s in candidates if region(s) == preferred_region
+                 and (capacity is None or busy(s) < capacity)]
+        if local:
+            candidates = local
+    return min(candidates, key=lambda s: (busy(s), s.id))
@@ -0,0 +1,86 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Content fingerprints for recognizing sources Panda has already encoded.
+
+Before an upload is submitted to Panda, the ``panda-worker`` stores the
+SHA-1 of its content in its meta data (:data:`META_FINGERPRINT`, see
+:func:`jobs.prepare_uploads`). Once Panda has finished encoding such an upload,
+the ID of the resulting Panda video is stored next to it
+(:data:`META_FINGERPRINT_VIDEO`). Together these rows form the index that
+:func:`find_encoded_video` looks up, so byte-identical content is not sent
+to Panda again.
+"""
+
+import hashlib
+import os
+
+from sqlalchemy.orm import aliased
+
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (META_FINGERPRINT,
+    META_FINGERPRINT_VIDEO)
+
+CHUNK_SIZE = 1024 * 1024
+
+def fingerprint_file(f, chunk_size=CHUNK_SIZE):
+    """Return the SHA-1 hex digest of a file object, read in chunks."""
+    sha1 = hashlib.sha1()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        sha1.update(chunk)
+    return unicode(sha1.hexdigest())
+
+def local_path(media_file):
+    """Return the path of the MediaFile on the local disk, if it has one."""
+    file_path = getattr(media_file.storage, 'file_path', None)
+    if file_path is None:
+        return None
+    path = file_path(media_file)
+    if path and os.path.isfile(path):
+        return path
+    return None
+
+def fingerprint_media_file(media_file):
+    """Return the fingerprint of a locally stored MediaFile, or None."""
+    path = local_path(media_file)
+    if not path:
+        return None
+    f = open(path, 'rb')
+    try:
+        return fingerprint_file(f)
+    finally:
+        f.close()
+
+def find_encoded_video(fingerprint, exclude_file_id=None):
+    """Return the ID of a completed Panda video with the given content, or None.
+
+    :param exclude_file_id: Ignore the index entry of this MediaFile.
+    """
+    fp_meta = aliased(MediaFilesMeta)
+    video_meta = aliased(MediaFilesMeta)
+    query = DBSession.query(video_meta.value)\
+        .filter(fp_meta.key == META_FINGERPRINT)\
+        .filter(fp_meta.value == fingerprint)\
+        .filter(video_meta.media_files_id == fp_meta.media_files_id)\
+        .filter(video_meta.key == META_FINGERPRINT_VIDEO)
+    if exclude_file_id is not None:
+        query = query.filter(fp_meta.media_files_id != exclude_file_id)
+    row = query.first()
+    return row and row[0] or None
+
+def forget_video(video_id):
+    """Remove a Panda video from the index, e.g. because it was deleted."""
+    rows = DBSession.query(MediaFilesMeta)\
+        .filter(MediaFilesMeta.key == META_FINGERPRINT_VIDEO)\
+        .filter(MediaFilesMeta.value == video_id)
+    for row in rows:
+        DBSession.delete(row)
@@ -0,0 +1,131 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Pick the Panda API host to talk to by how well it has been responding.
+
+Besides the API host chosen in the storage engine settings, fallback hosts
+can be configured which serve the same cloud. For every host, the process
+keeps a rolling (exponentially weighted) average of its response time and
+of its error rate, shared by all clients (:class:`HostHealth`).
+
+Reads go to the host that is expected to answer quickest, and are sent to
+the next one if a host can't be reached or doesn't answer in time (see
+:data:`REQUEST_TIMEOUT`). Writes go to the best host only:
+retrying them elsewhere could apply them twice. A host that just failed is
+avoided for a while, the longer the more often it failed in a row.
+
+Hosts that haven't been used yet rank behind all others, in the configured
+order. So the configured API host is used until it fails or is slower than
+a fallback host that had to step in for it. A host that hasn't been used
+for :data:`PROBE_INTERVAL` seconds is tried first once, so that it gets a
+chance to show that it has recovered.
+"""
+
+import threading
+import time
+
+ALPHA = 0.2
+"""Weight of the latest sample in the rolling averages."""
+
+COOLDOWN = 15
+"""Seconds a host is avoided after failing; doubles with each failure in a row."""
+
+MAX_COOLDOWN = 300
+
+PROBE_INTERVAL = 120
+
+class HostHealth(object):
+    """The recent response times and errors of one API host."""
+    def __init__(self, host):
+        self.host = host
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.last_failure = 0
+        self.last_used = 0
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, duration, ok):
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            self.last_used = time.time()
+            self.error_rate += ALPHA * ((not ok and 1.0 or 0.0) - self.error_rate)
+            if ok:
+                self.failures = 0
+                if self.latency is None:
+                    self.latency = duration
+                else:
+                    self.latency += ALPHA * (duration - self.latency)
+            else:
+                self.errors += 1
+                self.failures += 1
+                self.last_failure = time.time()
+        finally:
+            self.lock.release()
+
+    def cooling_down(self, now=None):
+        if not self.failures:
+            return False
+        cooldown = min(COOLDOWN * 2 ** (self.failures - 1), MAX_COOLDOWN)
+        return (now or time.time()) - self.last_failure < cooldown
+
+    def stale(self, now=None):
+        """Whether the figures of a host that was used before are outdated."""
+        return self.calls and (now or time.time()) - self.last_used > PROBE_INTERVAL
+
+    def cost(self):
+        """The expected time to get an answer, counting failed attempts."""
+        if self.latency is None:
+            return None
+        return self.latency / max(1 - self.error_rate, 0.05)
+
+    def as_dict(self):
+        return {
+            'host': self.host,
+            'latency': self.latency,
+            'error_rate': round(self.error_rate, 3),
+            'calls': self.calls,
+            'errors': self.errors,
+            'cooling_down': self.cooling_down(),
+        }
+
+_health = {}
+_health_lock = threading.Lock()
+
+def host_health(host):
+    """Return the :class:`HostHealth` of a host, shared by the whole process."""
+    _health_lock.acquire()
+    try:
+        if host not in _health:
+            _health[host] = HostHealth(host)
+        return _health[host]
+    finally:
+        _health_lock.release()
+
+def rank_hosts(hosts):
+    """Return the hosts, the one to try first first.
+
+    :param hosts: The configured hosts, the preferred one first.
+    """
+    now = time.time()
+    def key(item):
+        index, host = item
+        health = host_health(host)
+        if health.cooling_down(now):
+            return (2, None, index)
+        if health.stale(now):
+            return (0, None, index)
+        cost = health.cost()
+        return (1, cost is None, cost, index)
+    return [host for index, host in sorted(enumerate(hosts), key=key)]
+
+def host_report():
+    """Return the health of all hosts used by this process, for the stats."""
+    return [_health[host].as_dict() for host in sorted(_health)]
@@ -0,0 +1,348 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Background processing of Panda notifications and transcode submissions.
+
+Notifications from Panda only flag the MediaFile/Video association row (see
+:meth:`PandaHelper.queue_status_update`). Because the flag lives in the
+database it survives restarts, and because it is a single row per pairing,
+repeated notifications for the same video collapse into one update.
+
+Uploads likewise only record a transcode job with the source MediaFile (see
+:meth:`PandaHelper.queue_transcode`), which :func:`process_transcode_jobs`
+submits to Panda, unless Panda has already encoded identical content (see
+:mod:`fingerprint`).
+
+Both are run by the ``panda-worker`` paster command. With several Panda
+clouds configured, the worker picks the cloud for each new video as it
+submits it; see :mod:`clouds`.
+"""
+
+import logging
+import time
+
+from mediacore.model import MediaFile
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import (JOB_FAILED, JOB_PENDING,
+    JOB_SUBMITTED, META_FINGERPRINT, META_FINGERPRINT_VIDEO, META_TRANSCODE_JOB,
+    META_VIDEO_PREFIX, PRIORITY_UPLOAD, STATE_UPDATE_PENDING, PandaException,
+    loads)
+from mediacoreext.simplestation.panda.lib.clouds import (cloud_load,
+    panda_storages, pick_storage, storage_for_video)
+from mediacoreext.simplestation.panda.lib.fingerprint import (find_encoded_video,
+    fingerprint_media_file, forget_video)
+from mediacoreext.simplestation.panda.lib.ladder import (select_profiles,
+    source_info)
+from mediacoreext.simplestation.panda.lib.threads import (RateLimiter,
+    map_concurrently)
+
+log = logging.getLogger(__name__)
+
+def pending_status_updates():
+    """Return a list of ``(media_file_id, video_id)`` tuples awaiting an update."""
+    offset = len(META_VIDEO_PREFIX)
+    rows = DBSession.query(MediaFilesMeta.media_files_id, MediaFilesMeta.key)\
+        .filter(MediaFilesMeta.key.startswith(META_VIDEO_PREFIX))\
+        .filter(MediaFilesMeta.value == STATE_UPDATE_PENDING)\
+        .order_by(MediaFilesMeta.media_files_id)
+    return [(file_id, key[offset:]) for file_id, key in rows]
+
+def _set_update_flag(file_id, video_id, old, new):
+    """Change the flag of a MediaFile/Video pairing if it is ``old``.
+
+    This is a single conditional UPDATE, so a notification that comes in
+    concurrently is never overwritten.
+
+    :returns: True if the flag was changed.
+    """
+    return DBSession.query(MediaFilesMeta)\
+        .filter(MediaFilesMeta.media_files_id == file_id)\
+        .filter(MediaFilesMeta.key == META_VIDEO_PREFIX + video_id)\
+        .filter(MediaFilesMeta.value == old)\
+        .update({'value': new}, synchronize_session=False) > 0
+
+def files_of_video(video_id):
+    """Return all MediaFiles associated with a Panda video."""
+    return DBSession.query(MediaFile)\
+        .filter(MediaFilesMeta.media_files_id == MediaFile.id)\
+        .filter(MediaFilesMeta.key == META_VIDEO_PREFIX + video_id)\
+        .all()
+
+def process_status_updates(batch_size=50):
+    """Materialize completed encodings for all flagged videos.
+
+    The flags of a batch of ``batch_size`` videos are cleared and committed
+    before Panda is asked about them. A notification arriving meanwhile
+    flags the video again, so it is looked at once more on the next run
+    instead of being lost. Videos that are still encoding just stay
+    unflagged; Panda will notify us once more when their state changes.
+    Videos whose update fails are flagged again and retried on the next run.
+
+    :returns: The number of videos that were processed successfully.
+    """
+    storages = panda_storages()
+    if not storages:
+        return 0
+
+    pending = pending_status_updates()
+    processed = 0
+    for start in range(0, len(pending), batch_size):
+        batch = [(file_id, video_id)
+                 for file_id, video_id in pending[start:start + batch_size]
+                 if _set_update_flag(file_id, video_id, STATE_UPDATE_PENDING, None)]
+        DBSession.commit()
+        # Each batch must see Panda's current state, not a memoized one.
+        for storage in storages:
+            storage.panda_helper().client.clear_cache()
+        media = set()
+        for file_id, video_id in batch:
+            media_file = DBSession.query(MediaFile).get(file_id)
+            if media_file is None:
+                continue
+            helper = storage_for_video(video_id, storages).panda_helper()
+            DBSession.begin_nested()
+            try:
+                helper.video_status_update(media_file, video_id)
+                DBSession.commit()
+            except Exception, e:
+                log.exception('Updating Panda video %s of MediaFile %s failed: %s',
+                              video_id, file_id, e)
+                DBSession.rollback()
+                _set_update_flag(file_id, video_id, None, STATE_UPDATE_PENDING)
+                continue
+            media.add(media_file.media)
+            processed += 1
+        for m in media:
+            m.update_status()
+        DBSession.commit()
+    return processed
+
+def transcode_jobs():
+    """Return a list of ``(media_file_id, job)`` tuples for all transcode jobs."""
+    rows = DBSession.query(MediaFilesMeta.media_files_id, MediaFilesMeta.value)\
+        .filter(MediaFilesMeta.key == META_TRANSCODE_JOB)\
+        .order_by(MediaFilesMeta.media_files_id)
+    return [(file_id, loads(value)) for file_id, value in rows]
+
+def prepare_uploads(storages):
+    """Inspect new uploads before they are submitted to Panda.
+
+    Every pending upload is looked at once; its job is then marked as
+    ``prepared``. The source's dimensions are probed (see
+    :func:`ladder.source_info`) and its content fingerprinted (see
+    :mod:`fingerprint`). Both read the file, which is why this is left to
+    the worker instead of the upload request. If Panda can't be asked
+    whether the fingerprint's video still exists, the job stays unprepared
+    and is looked at again on the next pass.
+
+    :param storages: All :class:`PandaStorage` engines, see :mod:`clouds`.
+    :returns: The number of jobs that reused an existing video, see
+        :func:`reuse_encoded_video`.
+    """
+    reused = 0
+    for file_id, job in transcode_jobs():
+        if job['status'] != JOB_PENDING or 'uri' not in job \
+        or job.get('prepared'):
+            continue
+        media_file = DBSession.query(MediaFile).get(file_id)
+        if media_file is None:
+            continue
+        helper = storages[0].panda_helper()
+        if not job.get('source'):
+            job['source'] = source_info(media_file)
+        fingerprint = media_file.meta.get(META_FINGERPRINT)
+        if not fingerprint:
+            try:
+                fingerprint = fingerprint_media_file(media_file)
+            except IOError, e:
+                log.exception(e)
+            if fingerprint:
+                media_file.meta[META_FINGERPRINT] = fingerprint
+        # Kept even if Panda can't be asked right now, so that neither has
+        # to be done again.
+        helper.set_transcode_job(media_file, job)
+        DBSession.commit()
+
+        try:
+            if fingerprint and reuse_encoded_video(media_file, job,
+                                                   fingerprint, storages):
+                reused += 1
+                DBSession.commit()
+                continue
+        except PandaException, e:
+            DBSession.rollback()
+            log.warn('Could not check for existing encodings of MediaFile %s, '
+                     'trying again later: %s', file_id, e)
+            continue
+        job['prepared'] = True
+        helper.set_transcode_job(media_file, job)
+        DBSession.commit()
+    return reused
+
+def reuse_encoded_video(media_file, job, fingerprint, storages):
+    """Complete a pending upload whose content Panda has encoded before.
+
+    Instead of transcoding the upload again, the renditions are created
+    straight from the existing encodings. If the upload asks for profiles the
+    existing video lacks, the job is turned into one that only adds those.
+
+    :returns: True if an existing video was reused.
+    :raises PandaException: If Panda couldn't be asked about the video.
+    """
+    video_id = find_encoded_video(fingerprint, exclude_file_id=media_file.id)
+    if not video_id:
+        return False
+    helper = storage_for_video(video_id, storages).panda_helper()
+    try:
+        video = helper.client.get_video(video_id)
+        encodings = helper.client.get_encodings(video_id=video_id)
+    except PandaException, e:
+        if not e.not_found():
+            raise
+        # The video is gone from Panda.
+        log.warn('Dropping Panda video %s from the fingerprint index: %s', video_id, e)
+        forget_video(video_id)
+        return False
+    encodings = [e for e in encodings if e['status'] == 'success']
+
+    helper.create_renditions(media_file, video, encodings)
+    media_file.meta[META_FINGERPRINT_VIDEO] = video_id
+    have = helper.profile_ids_to_names([e['profile_id'] for e in encodings])
+    wanted = job['profiles'] + job.get('deferred_profiles', [])
+    if [name for name in wanted if name not in have]:
+        helper.queue_add_profiles(media_file, video_id, wanted,
+            priority=job.get('priority', PRIORITY_UPLOAD),
+            incremental=job.get('incremental', False))
+    else:
+        helper.clear_transcode_job(media_file)
+    media_file.media.update_status()
+    return True
+
+def submit_job(helper, job, limiter=None):
+    """Send a single job to Panda. Safe to call from a worker thread.
+
+    :param limiter: An optional :class:`threads.RateLimiter` for write requests.
+    :returns: A tuple of the Panda video ID and the number of encodings that
+        were started.
+    """
+    client = helper.client
+    if 'uri' in job:
+        source = job.get('source', {})
+        profiles = select_profiles(client.get_profiles(), job['profiles'],
+            source.get('width'), source.get('height'), source.get('bitrate'))
+        if limiter:
+            limiter.wait()
+        video = client.transcode_file(job['uri'], profiles,
+                                      job['state_update_url'])
+        return video['id'], len(profiles)
+
+    # Only add the profiles the existing video doesn't have yet.
+    video = client.get_video(job['video_id'])
+    profiles = select_profiles(client.get_profiles(), job['profiles'],
+        video['width'], video['height'])
+    wanted = helper.profile_names_to_ids(profiles)
+    existing = set(e['profile_id']
+                   for e in client.get_encodings(video_id=job['video_id']))
+    missing = [id for id in wanted if id not in existing]
+    for profile_id in missing:
+        if limiter:
+            limiter.wait()
+        client.add_transcode_profile(job['video_id'], profile_id)
+    return job['video_id'], len(missing)
+
+def process_transcode_jobs(scheduler, max_workers=4, rate=None,
+                           max_attempts=5, retry_delay=60, capacity=None,
+                           region=None):
+    """Submit the transcode jobs picked by the scheduler to Panda.
+
+    At most ``max_workers`` requests to Panda are in flight at any time, and
+    no more than ``rate`` jobs are submitted per second.
+    A failed submission is retried with exponential backoff, starting at
+    ``retry_delay`` seconds, until ``max_attempts`` is reached; after that the
+    job is marked as failed and left for an admin to look at.
+
+    Submitted jobs stay in the queue until their video is materialized by
+    :meth:`PandaHelper.video_status_update`, so that the scheduler knows how
+    busy the cloud is.
+
+    New videos go to the cloud picked by :func:`clouds.pick_storage`;
+    profiles are added to existing videos in the cloud that has them.
+
+    :param scheduler: A :class:`scheduler.Scheduler`.
+    :param capacity: The number of encodings each cloud runs in parallel.
+    :param region: The region whose clouds are preferred for new videos.
+    :returns: The number of jobs that were submitted successfully.
+    """
+    storages = panda_storages()
+    if not storages:
+        return 0
+
+    reused = prepare_uploads(storages)
+    if reused:
+        log.info('Reused existing Panda encodings for %d uploads.', reused)
+
+    jobs = transcode_jobs()
+    file_ids = dict((id(job), file_id) for file_id, job in jobs)
+    # Uploads that couldn't be prepared yet wait for the next pass.
+    selected = scheduler.select([job for file_id, job in jobs
+        if job['status'] != JOB_PENDING or 'uri' not in job
+        or job.get('prepared')])
+    if not selected:
+        return 0
+
+    # Decide on the clouds up front, the worker threads can't query the
+    # database.
+    load = cloud_load(job for file_id, job in jobs)
+    targets = {}
+    for job in selected:
+        if 'uri' in job:
+            storage = pick_storage(storages, load, capacity, region)
+            if storage is None:
+                continue
+            load[storage.id] = load.get(storage.id, 0) + len(job['profiles'])
+        else:
+            storage = storage_for_video(job['video_id'], storages)
+        targets[id(job)] = storage
+    selected = [job for job in selected if id(job) in targets]
+
+    limiter = rate and RateLimiter(rate) or None
+    def submit(job):
+        return submit_job(targets[id(job)].panda_helper(), job, limiter)
+
+    submitted = 0
+    for job, result, error in map_concurrently(submit, selected, max_workers):
+        file_id = file_ids[id(job)]
+        media_file = DBSession.query(MediaFile).get(file_id)
+        if media_file is None:
+            continue
+        storage = targets[id(job)]
+        helper = storage.panda_helper()
+        if error is None:
+            video_id, encodings = result
+            submitted += 1
+            if not encodings:
+                # Nothing was missing.
+                helper.clear_transcode_job(media_file)
+                continue
+            helper.associate_video_id(media_file, video_id)
+            job.update(status=JOB_SUBMITTED, video_id=video_id,
+                       encodings=encodings, submitted_at=time.time(),
+                       cloud=storage.id)
+            helper.set_transcode_job(media_file, job)
+            continue
+        log.warn('Submitting MediaFile %s to Panda failed: %s', file_id, error)
+        job['attempts'] += 1
+        job['error'] = unicode(error)
+        if job['attempts'] >= max_attempts:
+            job['status'] = JOB_FAILED
+        else:
+            job['next_attempt'] = time.time() + retry_delay * 2 ** (job['attempts'] - 1)
+        helper.set_transcode_job(media_file, job)
+    DBSession.commit()
+    return submitted
@@ -0,0 +1,134 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Pick the encoding profiles that are worth running for a given source.
+
+Transcoding a 320x240 clip into a 720x480 'hi' profile costs encoding time
+and storage without adding any quality, and so do 16:9 variants of a 4:3
+source. :func:`select_profiles` drops such profiles:
+
+- Profiles sharing a preset (e.g. ``h264`` and ``h264.16x9``) only differ in
+  their aspect ratio; only the one closest to the source's is kept.
+- Among profiles producing the same file type, those larger than the source
+  (or with a higher bitrate, if both are known) are dropped. The smallest
+  one is always kept so that every file type stays available.
+"""
+
+import logging
+import os
+import subprocess
+
+from mediacoreext.simplestation.panda.lib import loads
+from mediacoreext.simplestation.panda.lib.fingerprint import local_path
+
+log = logging.getLogger(__name__)
+
+UPSCALE_TOLERANCE = 1.1
+"""Profiles up to this factor larger than the source still count as a fit."""
+
+def source_info(media_file):
+    """Return a dict with the width, height and bitrate of a source MediaFile.
+
+    Values MediaCore doesn't know are probed from the local file with
+    ``ffprobe``, if possible. Unknown values are None.
+    """
+    info = {
+        'width': getattr(media_file, 'width', None),
+        'height': getattr(media_file, 'height', None),
+        'bitrate': getattr(media_file, 'bitrate', None),
+    }
+    if not (info['width'] and info['height']):
+        path = local_path(media_file)
+        if path:
+            probed = probe_file(path)
+            for key in info:
+                info[key] = info[key] or probed.get(key)
+    return info
+
+def probe_file(path):
+    """Return the width, height and bitrate (kbps) of a video file via ffprobe.
+
+    :returns: A dict, empty if ffprobe isn't installed or can't read the file.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=width,height,bit_rate', '-of', 'json', path]
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'))
+        output = proc.communicate()[0]
+    except OSError:
+        return {}
+    if proc.returncode != 0:
+        return {}
+    try:
+        stream = loads(output)['streams'][0]
+    except (ValueError, KeyError, IndexError):
+        return {}
+    info = {'width': stream.get('width'), 'height': stream.get('height')}
+    if stream.get('bit_rate'):
+        info['bitrate'] = int(stream['bit_rate']) // 1000
+    return info
+
+def _aspect(width, height):
+    return float(width) / height
+
+def select_profiles(profiles, names, width, height, bitrate=None):
+    """Return the subset of ``names`` worth encoding for the given source.
+
+    :param profiles: The Panda profile dicts, as returned by
+        :meth:`PandaClient.get_profiles`.
+    :param names: The names of the requested profiles.
+    :param width: Source width in pixels, or None if unknown.
+    :param height: Source height in pixels, or None if unknown.
+    :param bitrate: Source bitrate in kbps, or None if unknown.
+    :returns: A list of profile names, in the order of ``names``.
+    """
+    if not (width and height):
+        return list(names)
+    requested = [p for p in profiles if p['name'] in names]
+    # Let Panda complain about profiles it doesn't know, as it always did.
+    unknown = set(names) - set(p['name'] for p in requested)
+    source_aspect = _aspect(width, height)
+
+    # Of each set of aspect ratio variants keep the best fitting one.
+    variants = {}
+    for p in requested:
+        variants.setdefault(p.get('preset_name') or p['name'], []).append(p)
+    fitting = []
+    for group in variants.itervalues():
+        sized = [p for p in group if p['width'] and p['height']]
+        if len(sized) < 2:
+            fitting.extend(group)
+            continue
+        best = min(abs(_aspect(p['width'], p['height']) - source_aspect)
+                   for p in sized)
+        fitting.extend(p for p in sized
+                       if abs(_aspect(p['width'], p['height']) - source_aspect) == best)
+        fitting.extend(p for p in group if p not in sized)
+
+    # Of each file type skip the profiles which would only upscale.
+    by_type = {}
+    for p in fitting:
+        by_type.setdefault(p['extname'], []).append(p)
+    selected = set()
+    for group in by_type.itervalues():
+        group.sort(key=lambda p: (p['width'] or 0) * (p['height'] or 0))
+        selected.add(group[0]['name'])
+        for p in group[1:]:
+            if _adds_value(p, width, height, bitrate):
+                selected.add(p['name'])
+
+    return [name for name in names if name in selected or name in unknown]
+
+def _adds_value(profile, width, height, bitrate):
+    if profile['width'] > width * UPSCALE_TOLERANCE \
+    or profile['height'] > height * UPSCALE_TOLERANCE:
+        return False
+    profile_bitrate = profile.get('video_bitrate')
+    if bitrate and profile_bitrate and profile_bitrate > bitrate * UPSCALE_TOLERANCE:
+        return False
+    return True
@@ -0,0 +1,223 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Record the Panda API calls made while serving a request.
+
+Profiling is opt-in: add the ``panda_profiler`` filter to the WSGI pipeline
+of your deployment ini file::
+
+    [filter:panda-profiler]
+    use = egg:MediaCore-Panda#panda_profiler
+    # Show the calls in a collapsible panel at the bottom of HTML pages.
+    panel = true
+
+    [pipeline:main]
+    pipeline = panda-profiler mediacore
+
+The filter puts an empty list into the WSGI environ, which
+:class:`PandaClient` appends a :class:`Call` to for every request it makes
+(or answers from its cache) while the list is there. At the end of the
+request the calls are logged as a single JSON line.
+
+Calls made from worker threads (see :mod:`threads`) aren't recorded, since
+those threads don't see the Pylons request.
+"""
+
+import logging
+import sys
+import time
+from cgi import escape
+
+from paste.deploy.converters import asbool
+from pylons import request
+
+log = logging.getLogger(__name__)
+
+ENVIRON_KEY = 'mediacoreext.panda.calls'
+
+class Call(object):
+    """A single Panda API call."""
+    __slots__ = ('method', 'url', 'params', 'duration', 'cached', 'size',
+                 'caller', 'host')
+
+    def __init__(self, method, url, params, duration, cached, size, caller,
+                 host=None):
+        self.method = method
+        self.url = url
+        self.params = params
+        self.duration = duration
+        self.cached = cached
+        self.size = size
+        self.caller = caller
+        self.host = host
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+def recorded_calls():
+    """Return the list of calls of the current request, or None.
+
+    None means that the current request isn't profiled, or that there is no
+    current request at all, e.g. in the worker command.
+    """
+    try:
+        return request.environ.get(ENVIRON_KEY)
+    except TypeError:
+        # Not called from within a web request.
+        return None
+
+def record_call(method, url, params, started, cached=False, size=None,
+                host=None):
+    """Add a call to the current request's profile, if it is profiled.
+
+    :param started: The :func:`time.time` at which the call was started.
+    :param size: The size of the response body in bytes.
+    :param host: The API host that answered, see :mod:`hosts`.
+    """
+    calls = recorded_calls()
+    if calls is None:
+        return
+    calls.append(Call(method, url, dict(params or {}),
+                      round(time.time() - started, 4), cached, size,
+                      _caller(), host))
+
+def _caller():
+    """Name the function outside of the client that made the call.
+
+    That's usually a :class:`PandaHelper` method.
+    """
+    from mediacoreext.simplestation.panda.lib import PandaClient
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_globals.get('__name__') != __name__ and \
+        not isinstance(frame.f_locals.get('self'), PandaClient):
+            self = frame.f_locals.get('self')
+            name = frame.f_code.co_name
+            if self is not None:
+                name = '%s.%s' % (type(self).__name__, name)
+            return '%s:%s' % (frame.f_globals.get('__name__'), name)
+        frame = frame.f_back
+    return None
+
+def summarize(calls):
+    """Return a JSON serializable summary of the given calls.
+
+    Uncached calls of the same URL with the same parameters are counted as
+    ``repeated``: those are the redundant ones.
+    """
+    seen = set()
+    repeated = 0
+    for call in calls:
+        key = (call.method, call.url, frozenset(call.params.iteritems()))
+        if key in seen and not call.cached:
+            repeated += 1
+        seen.add(key)
+    return {
+        'calls': len(calls),
+        'cached': len([c for c in calls if c.cached]),
+        'repeated': repeated,
+        'duration': round(sum(c.duration for c in calls), 4),
+        'size': sum(c.size or 0 for c in calls),
+        'details': [c.as_dict() for c in calls],
+    }
+
+def render_panel(calls, summary):
+    """Return the HTML of the debug panel."""
+    rows = []
+    for i, call in enumerate(calls):
+        params = ', '.join('%s=%s' % item for item in sorted(call.params.items()))
+        rows.append(
+            '<tr><td>%d</td><td>%s %s%s</td><td>%s</td><td>%.1f</td>'
+            '<td>%s</td><td>%s</td><td>%s</td></tr>' % (
+            i + 1, call.method, escape(call.host or ''), escape(call.url),
+            escape(params),
+            call.duration * 1000, call.cached and 'hit' or 'miss',
+            call.size is None and '-' or call.size, escape(call.caller or '')))
+    return (
+        '<div id="panda-profiler" style="clear:both;margin:1em;font:11px monospace">'
+        '<a href="#" onclick="var t=this.nextSibling;'
+        't.style.display=t.style.display==\'none\'?\'\':\'none\';return false;">'
+        'Panda: %(calls)d calls, %(cached)d cached, %(repeated)d repeated, '
+        '%(ms).1f ms, %(size)d bytes</a>'
+        '<table style="display:none" cellpadding="2">'
+        '<tr><th>#</th><th>Request</th><th>Params</th><th>ms</th>'
+        '<th>Cache</th><th>Bytes</th><th>Caller</th></tr>%(rows)s</table>'
+        '</div>' % dict(summary, ms=summary['duration'] * 1000,
+                        rows=''.join(rows)))
+
+class ProfilerMiddleware(object):
+    """Profile the Panda calls of every request, see the module docstring.
+
+    :param panel: Append the debug panel to HTML responses.
+    """
+    def __init__(self, app, panel=False):
+        self.app = app
+        self.panel = panel
+
+    def __call__(self, environ, start_response):
+        calls = environ[ENVIRON_KEY] = []
+        if not self.panel:
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+                self.log(environ, calls)
+            return
+
+        # Hold back HTML pages to add the panel, pass everything else on.
+        captured = []
+        body = []
+        def buffer(status, headers, exc_info=None):
+            content_type = dict((k.lower(), v) for k, v in headers)\
+                .get('content-type', '')
+            if content_type.startswith('text/html'):
+                captured[:] = [status, headers, exc_info]
+                return body.append
+            del captured[:]
+            del body[:]
+            return start_response(status, headers, exc_info)
+        try:
+            result = self.app(environ, buffer)
+            try:
+                for chunk in result:
+                    if captured:
+                        body.append(chunk)
+                    else:
+                        yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            if not captured:
+                return
+            status, headers, exc_info = captured
+            page = ''.join(body)
+            if calls and '</body>' in page:
+                panel = render_panel(calls, summarize(calls))
+                page = page.replace('</body>', panel + '</body>', 1)
+                headers = [(k, v) for k, v in headers
+                           if k.lower() != 'content-length']
+                headers.append(('Content-Length', str(len(page))))
+            start_response(status, headers, exc_info)
+            yield page
+        finally:
+            self.log(environ, calls)
+
+    def log(self, environ, calls):
+        if not calls:
+            return
+        from mediacoreext.simplestation.panda.lib import dumps
+        summary = summarize(calls)
+        summary['method'] = environ.get('REQUEST_METHOD')
+        summary['path'] = environ.get('PATH_INFO')
+        log.info('Panda calls: %s', dumps(summary))
+
+def make_profiler_filter(app, global_conf, panel=False):
+    """Paste filter factory for :class:`ProfilerMiddleware`."""
+    return ProfilerMiddleware(app, panel=asbool(panel))
@@ -5,6 +5,13 @@
 # (at your option) any later version.
 # See LICENSE.txt in the main project directory, for more information.
 
+import logging
+
+from mediacoreext.simplestation.panda.lib import PandaException, loads
+from mediacoreext.simplestation.panda.lib.threads import map_concurrently
+
+log = logging.getLogger(__name__)
+
 preset_encodings = [
     {
         'name': 'h264',
@@ -124,13 +131,100 @@ custom_profiles = [
     },
 ]
 
+profile_sets = {
+    'web': web_profiles,
+    'custom': custom_profiles,
+}
+
+def load_profiles(path):
+    """Read the desired profiles from a JSON file.
+
+    The file holds a list of profile dicts like those in :data:`web_profiles`:
+    ``name`` is required, all other keys are passed on to Panda as given.
+    """
+    f = open(path)
+    try:
+        profiles = loads(f.read())
+    finally:
+        f.close()
+    for p in profiles:
+        if not p.get('name'):
+            raise PandaException('Every profile needs a name.', path)
+    return profiles
+
+def plan_reconciliation(existing, desired, prune=False, protected=()):
+    """Work out what has to change for the cloud to have the desired profiles.
+
+    :param existing: The profile dicts of the cloud, as returned by
+        :meth:`PandaClient.get_profiles`.
+    :param desired: The wanted profile dicts, matched to existing ones by name.
+    :param prune: Also delete the existing profiles which aren't desired.
+    :param protected: Names of profiles that must never be deleted, e.g.
+        those selected in the storage settings.
+    :returns: A list of ``(action, name, data)`` tuples, where action is
+        'create' (data is the desired dict), 'update' (data is a tuple of the
+        profile ID and a dict of the changed settings) or 'delete' (data is
+        the profile ID).
+    """
+    by_name = dict((p['name'], p) for p in existing)
+    plan = []
+    for spec in desired:
+        current = by_name.get(spec['name'])
+        if current is None:
+            plan.append(('create', spec['name'], spec))
+            continue
+        changes = dict((k, v) for k, v in spec.iteritems()
+                       if k != 'name' and current.get(k) != v)
+        if changes:
+            plan.append(('update', spec['name'], (current['id'], changes)))
+    if prune:
+        wanted = set(p['name'] for p in desired) | set(protected)
+        for p in existing:
+            if p['name'] not in wanted:
+                plan.append(('delete', p['name'], p['id']))
+    return plan
+
+def reconcile_profiles(client, desired, prune=False, protected=(),
+                       dry_run=False, max_workers=4):
+    """Create, update and (optionally) delete profiles to match ``desired``.
+
+    The current profiles are fetched with a single listing call and all
+    changes are sent to Panda concurrently. See :func:`plan_reconciliation`
+    for the parameters.
+
+    :param client: The :class:`PandaClient` of the cloud.
+    :param dry_run: Only return the plan, don't change anything.
+    :returns: A tuple of the plan and a dict mapping the names of profiles
+        that couldn't be changed to error messages.
+    """
+    client.clear_cache()
+    plan = plan_reconciliation(client.get_profiles(), desired, prune, protected)
+    if dry_run or not plan:
+        return plan, {}
+
+    def apply(step):
+        action, name, data = step
+        if action == 'create':
+            if 'command' in data:
+                return client.add_profile(**data)
+            return client.add_profile_from_preset(**data)
+        elif action == 'update':
+            profile_id, changes = data
+            return client.update_profile(profile_id, **changes)
+        elif not client.delete_profile(data):
+            raise PandaException('Could not delete profile.', name)
+
+    failed = {}
+    for step, result, error in map_concurrently(apply, plan, max_workers):
+        if error is not None:
+            log.error('Could not %s profile %r: %s', step[0], step[1], error)
+            failed[step[1]] = unicode(error)
+    # Profile names and IDs are memoized by the client.
+    client.clear_cache()
+    return plan, failed
+
 def add_custom_profiles():
-    # Add all the custom profiles to the first existing PandaStorage instance.
-    from mediacore.model import DBSession
-    from mediacoreext.simplestation.panda.lib.storage import PandaStorage
-    ps = DBSession.query(PandaStorage).all()[0]
-    profiles = ps.panda_helper().client.get_profiles()
-    pnames = [p['name'] for p in profiles]
-    for x in custom_profiles:
-        if x['name'] not in pnames:
-            ps.panda_helper().client.add_profile_from_preset(**x)
+    # Add all the custom profiles to every PandaStorage instance.
+    from mediacoreext.simplestation.panda.lib.clouds import panda_storages
+    for ps in panda_storages():
+        reconcile_profiles(ps.panda_helper().client, custom_profiles)
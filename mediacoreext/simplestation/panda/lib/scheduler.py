@@ -0,0 +1,118 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Decide which queued transcode jobs are sent to Panda next.
+
+Panda works through its own queue in submission order, so anything we send
+it competes on equal terms. To keep a large backfill from starving fresh
+uploads, jobs wait in the local queue (see :mod:`jobs`) until the scheduler
+lets them through:
+
+- every job belongs to a priority class (:data:`PRIORITIES`),
+- each class may only keep a share of the cloud's concurrent encoding
+  capacity busy, and all classes together no more than the full capacity;
+  a job that is too large for its share on its own is let through when its
+  class is idle and it fits the capacity (or the cloud is idle),
+- jobs gain priority while they wait (aging), so a backfill still drains
+  while uploads keep coming in.
+"""
+
+import math
+import time
+
+from mediacoreext.simplestation.panda.lib import (JOB_PENDING, JOB_SUBMITTED,
+    PRIORITIES, PRIORITY_BACKFILL, PRIORITY_REPUBLISH, PRIORITY_UPLOAD)
+
+default_shares = {
+    PRIORITY_UPLOAD: 1.0,
+    PRIORITY_REPUBLISH: 0.5,
+    PRIORITY_BACKFILL: 0.25,
+}
+
+class Scheduler(object):
+    """
+    :param capacity: The number of encodings the Panda cloud runs in parallel.
+    :param shares: A dict mapping each priority class to the fraction of the
+        capacity it may use. Every class gets at least one encoding.
+    :param aging: Seconds of waiting it takes for a job to move up one class.
+    :param in_flight_timeout: Submitted jobs older than this many seconds no
+        longer count as in flight. This keeps encodings that never complete
+        (e.g. failed ones nobody retried) from blocking their class forever.
+    """
+    def __init__(self, capacity, shares=None, aging=900, in_flight_timeout=6*3600):
+        self.capacity = capacity
+        self.aging = aging
+        self.in_flight_timeout = in_flight_timeout
+        if shares is None:
+            shares = default_shares
+        self.caps = {}
+        for priority in PRIORITIES:
+            share = shares.get(priority, 1.0)
+            self.caps[priority] = max(1, int(math.ceil(capacity * share)))
+
+    def in_flight(self, jobs, now=None):
+        """Count the encodings submitted to Panda but not yet completed, per class.
+
+        :param jobs: An iterable of job dicts.
+        :rtype: dict
+        """
+        if now is None:
+            now = time.time()
+        counts = dict((p, 0) for p in PRIORITIES)
+        for job in jobs:
+            if job['status'] != JOB_SUBMITTED:
+                continue
+            if now - job['submitted_at'] > self.in_flight_timeout:
+                continue
+            counts[job_priority(job)] += job['encodings']
+        return counts
+
+    def rank(self, job, now):
+        """Return the job's effective rank; lower ranks are submitted first."""
+        waited = max(0, now - job['created'])
+        return PRIORITIES.index(job_priority(job)) - waited / float(self.aging)
+
+    def select(self, jobs, now=None):
+        """Pick the pending jobs which may be submitted to Panda right now.
+
+        :param jobs: An iterable of all job dicts, including those already
+            submitted (which are needed to know the current load).
+        :returns: The selected jobs, in the order they should be submitted.
+        """
+        if now is None:
+            now = time.time()
+        jobs = list(jobs)
+        in_flight = self.in_flight(jobs, now)
+        total = sum(in_flight.values())
+
+        due = [j for j in jobs
+               if j['status'] == JOB_PENDING and j['next_attempt'] <= now]
+        due.sort(key=lambda j: (self.rank(j, now), j['created']))
+
+        selected = []
+        for job in due:
+            if total >= self.capacity:
+                break
+            priority = job_priority(job)
+            cost = len(job['profiles'])
+            fits = in_flight[priority] + cost <= self.caps[priority] \
+                and total + cost <= self.capacity
+            # A job larger than its class's share could never fit, so it may
+            # run once nothing else of its class is in flight, as long as
+            # the cloud has room for it or is idle.
+            oversized = cost > self.caps[priority] and not in_flight[priority] \
+                and (not total or total + cost <= self.capacity)
+            if not fits and not oversized:
+                continue
+            in_flight[priority] += cost
+            total += cost
+            selected.append(job)
+        return selected
+
+def job_priority(job):
+    # Jobs queued before priorities existed were all uploads.
+    return job.get('priority', PRIORITY_UPLOAD)
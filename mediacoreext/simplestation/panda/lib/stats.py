@@ -0,0 +1,189 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Encoding throughput figures, per Panda profile.
+
+Every rendition created from a Panda encoding keeps the encoding's timing
+and size figures in its meta data (see
+:meth:`PandaHelper.record_encoding_stats`). This module aggregates them to
+answer questions like "how many seconds of video does the h264.hi profile
+encode per second?", "how long do jobs wait in Panda's queue?" and "when
+will this encoding be done?".
+"""
+
+import calendar
+import threading
+import time
+from datetime import datetime
+
+from mediacore.model.media import MediaFilesMeta
+from mediacore.model.meta import DBSession
+
+from mediacoreext.simplestation.panda.lib import META_ENCODING_STATS, loads
+
+REPORT_TTL = 300
+"""Seconds for which :func:`cached_profile_report` reuses its result."""
+
+ESTIMATE_SAMPLES = 1000
+"""Number of the latest encodings :func:`cached_profile_report` looks at."""
+
+def parse_time(value):
+    """Parse a Panda timestamp into seconds since the epoch.
+
+    Panda uses ``2011/03/15 12:34:56 +0000``; ISO 8601 style timestamps are
+    understood as well.
+
+    :returns: A float, or None if ``value`` is empty or can't be parsed.
+    """
+    if not value:
+        return None
+    stamp = value[:19].replace('-', '/').replace('T', ' ')
+    try:
+        dt = datetime.strptime(stamp, '%Y/%m/%d %H:%M:%S')
+    except ValueError:
+        return None
+    seconds = calendar.timegm(dt.timetuple())
+    offset = value[19:].strip().replace(':', '')
+    if len(offset) == 5 and offset[0] in '+-':
+        sign = offset[0] == '-' and -1 or 1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return float(seconds)
+
+def load_samples(since=None, limit=None):
+    """Return the recorded figures of all encodings created after ``since``.
+
+    :param since: Seconds since the epoch, or None for all samples.
+    :param limit: Only look at this many of the most recently recorded
+        encodings.
+    :rtype: list of dicts
+    """
+    rows = DBSession.query(MediaFilesMeta.value)\
+        .filter(MediaFilesMeta.key == META_ENCODING_STATS)
+    if limit:
+        rows = rows.order_by(MediaFilesMeta.id.desc()).limit(limit)
+    samples = []
+    for (value,) in rows:
+        sample = loads(value)
+        created = parse_time(sample['created_at'])
+        if since and (created is None or created < since):
+            continue
+        sample['created'] = created
+        sample['started'] = parse_time(sample['started_encoding_at'])
+        samples.append(sample)
+    return samples
+
+def profile_report(samples):
+    """Aggregate samples per profile.
+
+    :returns: A dict mapping profile IDs to dicts with these keys:
+
+        - ``name``: the profile name at the time of the last encoding,
+        - ``count``: the number of encodings,
+        - ``speed``: seconds of video encoded per second of encoding time,
+        - ``wait``: average seconds between submission and start of encoding,
+        - ``encoding_time``: total seconds spent encoding,
+        - ``file_size``: total bytes produced,
+        - ``bytes_per_second``: bytes produced per second of video.
+
+        Figures that can't be computed from the samples are None.
+    """
+    totals = {}
+    for s in samples:
+        t = totals.setdefault(s['profile_id'], {
+            'name': None, 'count': 0, 'encoding_time': 0, 'file_size': 0,
+            'duration': 0, 'timed_duration': 0, 'wait': 0, 'waits': 0,
+        })
+        t['name'] = s.get('profile') or t['name']
+        t['count'] += 1
+        duration = (s['duration'] or 0) / 1000.0
+        t['duration'] += duration
+        t['file_size'] += s['file_size'] or 0
+        if s['encoding_time']:
+            t['encoding_time'] += s['encoding_time']
+            t['timed_duration'] += duration
+        if s['created'] is not None and s['started'] is not None:
+            t['wait'] += max(0, s['started'] - s['created'])
+            t['waits'] += 1
+
+    report = {}
+    for profile_id, t in totals.iteritems():
+        wait = None
+        if t['waits']:
+            wait = t['wait'] / t['waits']
+        report[profile_id] = {
+            'name': t['name'],
+            'count': t['count'],
+            'speed': t['encoding_time'] and t['timed_duration'] / t['encoding_time'] or None,
+            'wait': wait,
+            'encoding_time': t['encoding_time'],
+            'file_size': t['file_size'],
+            'bytes_per_second': t['duration'] and t['file_size'] / t['duration'] or None,
+        }
+    return report
+
+_cache_lock = threading.Lock()
+_cache = {'expires': 0, 'report': None}
+
+def cached_profile_report():
+    """Return the :func:`profile_report` of the latest samples, cached for a while.
+
+    This is used to estimate the remaining time of encodings on every status
+    page, so it only reads the last :data:`ESTIMATE_SAMPLES` encodings
+    instead of all that were ever recorded. Those also reflect how Panda is
+    doing right now best.
+    """
+    _cache_lock.acquire()
+    try:
+        if _cache['expires'] < time.time():
+            _cache['report'] = profile_report(load_samples(limit=ESTIMATE_SAMPLES))
+            _cache['expires'] = time.time() + REPORT_TTL
+        return _cache['report']
+    finally:
+        _cache_lock.release()
+
+def estimate_remaining(encoding, video, report, now=None):
+    """Estimate the seconds until an in-flight encoding is done.
+
+    :param encoding: The Panda encoding dict.
+    :param video: The Panda video dict the encoding belongs to.
+    :param report: A :func:`profile_report`.
+    :returns: Seconds as a float, or None if there is no basis for a guess.
+    """
+    if now is None:
+        now = time.time()
+    figures = report.get(encoding['profile_id'])
+    duration = (encoding.get('duration') or video.get('duration') or 0) / 1000.0
+    if not figures or not figures['speed'] or not duration:
+        return None
+    encode_time = duration / figures['speed']
+    if encoding['started_encoding_at']:
+        progress = (encoding.get('encoding_progress') or 0) / 100.0
+        return max(0.0, encode_time * (1 - progress))
+    created = parse_time(encoding['created_at'])
+    waited = created and now - created or 0
+    return max(0.0, (figures['wait'] or 0) - waited) + encode_time
+
+def estimate_all(encoding_dicts, video_dicts, report=None):
+    """Estimate the remaining time of all unfinished encodings.
+
+    :param encoding_dicts: A dict mapping file IDs to dicts of encodings by
+        ID, as built by :func:`mediacore_plugin.add_panda_vars`.
+    :param video_dicts: The matching dict of videos.
+    :returns: A dict mapping encoding IDs to seconds.
+    """
+    if report is None:
+        report = cached_profile_report()
+    etas = {}
+    for file_id, encodings in encoding_dicts.iteritems():
+        for e in encodings.itervalues():
+            if e['status'] != 'processing':
+                continue
+            video = video_dicts.get(file_id, {}).get(e['video_id'], {})
+            eta = estimate_remaining(e, video, report)
+            if eta is not None:
+                etas[e['id']] = eta
+    return etas
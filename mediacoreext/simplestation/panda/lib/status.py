@@ -0,0 +1,245 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""The encoding status of a media item, as data for the admin status box.
+
+The status box shows one row per queued transcode job and per Panda
+encoding. :func:`status_rows` turns the variables set up by
+:func:`mediacore_plugin.add_panda_vars` into plain dicts for those rows, and
+:func:`version` derives a version string from them, which serves as the
+ETag of the status.
+
+To answer "what changed since version X", the row hashes of recently
+served versions are remembered (:class:`StatusHistory`). If a client asks
+for a version that isn't remembered (any more), it simply gets all rows.
+
+Clients long-poll for changes: a request that already has the current
+version is held until Panda notifies us about one of the media's videos
+(see :class:`ChangeNotifier`), or, while something is encoding, until the
+next progress check is due. Notifications only wake requests held by the
+same process; requests in other processes notice the change on their next
+check or poll.
+"""
+
+import threading
+import time
+from hashlib import sha1
+
+from mediacore.lib.helpers import url_for
+
+from mediacoreext.simplestation.panda.lib import dumps
+
+HISTORY_SIZE = 1000
+"""Number of versions :class:`StatusHistory` remembers, across all media."""
+
+MAX_WAIT = 25
+"""Seconds a status request is held at most, below common proxy timeouts."""
+
+PROGRESS_INTERVAL = 10
+"""Seconds between checks of a held request while something is encoding."""
+
+MAX_WAITERS = 4
+"""Requests held at once per process, so they can't take all the threads."""
+
+def status_rows(media, panda_vars):
+    """Return the rows of the status box.
+
+    :param panda_vars: The result of :func:`mediacore_plugin.add_panda_vars`.
+    :returns: A list of ``(row_id, row)`` tuples in display order, where
+        ``row`` is a JSON serializable dict.
+    """
+    rows = []
+    jobs = panda_vars['transcode_jobs']
+    encoding_dicts = panda_vars['encoding_dicts']
+    video_dicts = panda_vars['video_dicts']
+    profile_names = panda_vars['profile_names']
+    etas = panda_vars['encoding_etas']
+
+    for file in media.files:
+        job = jobs.get(file.id)
+        if job:
+            rows.append(('panda-job-%s' % file.id, {
+                'type': 'job',
+                'file_type': file.type,
+                'file_name': file.display_name,
+                'status': job['status'],
+                'attempts': job['attempts'],
+                'error': job['error'],
+            }))
+    for file in media.files:
+        for e_id, e in sorted(encoding_dicts.get(file.id, {}).iteritems()):
+            video = video_dicts[file.id][e['video_id']]
+            started = bool(e['started_encoding_at'])
+            if e['status'] == 'fail' or (video['status'] == 'fail' and not started):
+                status = 'failed'
+            elif started:
+                status = 'encoding'
+            else:
+                status = 'queued'
+            eta = etas.get(e_id)
+            rows.append(('panda-encoding-%s' % e_id, {
+                'type': 'encoding',
+                'file_type': file.type,
+                'file_name': file.display_name,
+                'profile': profile_names.get(e['profile_id'], e['profile_id']),
+                'status': status,
+                'progress': e['encoding_progress'] or 0,
+                'eta_minutes': status != 'failed' and eta is not None
+                               and int(eta // 60) + 1 or None,
+                'retry_url': url_for(controller='/panda/admin/media',
+                    action='panda_retry', file_id=file.id, encoding_id=e_id),
+                'cancel_url': url_for(controller='/panda/admin/media',
+                    action='panda_cancel', file_id=file.id, encoding_id=e_id),
+            }))
+    return rows
+
+def row_hash(row):
+    return sha1(dumps(row)).hexdigest()[:12]
+
+def version(hashes):
+    """Derive the version of a status from its row hashes.
+
+    :param hashes: A list of ``(row_id, hash)`` tuples in display order.
+    """
+    return sha1(dumps(hashes)).hexdigest()[:16]
+
+class StatusHistory(object):
+    """Remember the row hashes of recently served status versions.
+
+    Shared by all requests of a process, hence the lock.
+    """
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.versions = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def add(self, media_id, version, hashes):
+        self.lock.acquire()
+        try:
+            key = (media_id, version)
+            if key in self.versions:
+                return
+            self.versions[key] = dict(hashes)
+            self.order.append(key)
+            while len(self.order) > self.size:
+                del self.versions[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def get(self, media_id, version):
+        """Return a dict of row hashes by row ID, or None if unknown."""
+        return self.versions.get((media_id, version))
+
+history = StatusHistory()
+
+def media_status(media, panda_vars, since=None):
+    """Return the status of the media's encodings, or what changed about it.
+
+    :param since: The version the client has. If it is known, only the rows
+        that were added or changed since are included, plus the IDs of the
+        rows that were removed.
+    :returns: A dict with the ``version``, the ``rows`` by ID, their
+        ``order`` (all row IDs, in display order), the ``removed`` row IDs,
+        whether this is a ``delta``, and whether all encodings are ``done``.
+    """
+    rows = status_rows(media, panda_vars)
+    hashes = [(row_id, row_hash(row)) for row_id, row in rows]
+    current = version(hashes)
+    history.add(media.id, current, hashes)
+
+    previous = since and history.get(media.id, since) or None
+    if previous is None:
+        changed = dict(rows)
+        removed = []
+    else:
+        changed = dict((row_id, row) for (row_id, row), (x, h)
+                       in zip(rows, hashes) if previous.get(row_id) != h)
+        ids = set(row_id for row_id, row in rows)
+        removed = [row_id for row_id in previous if row_id not in ids]
+    return {
+        'version': current,
+        'delta': previous is not None,
+        'rows': changed,
+        'order': [row_id for row_id, row in rows],
+        'removed': removed,
+        # Completed encodings are no longer associated, so no rows means done.
+        'done': not rows,
+        'encoding': any(row['status'] == 'encoding' for row_id, row in rows),
+    }
+
+class ChangeNotifier(object):
+    """Wake the status requests that wait for a media item to change.
+
+    Every media item has a counter which :meth:`notify` bumps. A request
+    takes the counter before it looks at the status, and then waits for it
+    to change, so that no notification slips through in between.
+    """
+    def __init__(self, max_waiters=MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self.waiters = 0
+        self.counters = {}
+        self.condition = threading.Condition()
+
+    def counter(self, media_id):
+        return self.counters.get(media_id, 0)
+
+    def notify(self, media_id):
+        self.condition.acquire()
+        try:
+            self.counters[media_id] = self.counter(media_id) + 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait(self, media_id, counter, timeout):
+        """Wait up to ``timeout`` seconds for the media's counter to change.
+
+        :returns: True if it changed, False on timeout, or None without
+            waiting if too many requests are waiting already.
+        """
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            if self.waiters >= self.max_waiters:
+                return None
+            self.waiters += 1
+            try:
+                while self.counter(media_id) == counter:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.waiters -= 1
+        finally:
+            self.condition.release()
+
+notifier = ChangeNotifier()
+
+def wait_for_status(media_id, get_status, since, timeout):
+    """Return the status as soon as it differs from the version ``since``.
+
+    :param get_status: A callable returning the current :func:`media_status`.
+        It is called again whenever the media is notified about, and every
+        :data:`PROGRESS_INTERVAL` seconds while something is encoding.
+    :param timeout: Seconds to wait at most, capped at :data:`MAX_WAIT`.
+    :returns: The last status, which is unchanged if the wait timed out.
+    """
+    deadline = time.time() + min(timeout, MAX_WAIT)
+    while True:
+        counter = notifier.counter(media_id)
+        status = get_status()
+        remaining = deadline - time.time()
+        if not since or status['version'] != since or remaining <= 0:
+            return status
+        if status['encoding']:
+            remaining = min(remaining, PROGRESS_INTERVAL)
+        changed = notifier.wait(media_id, counter, remaining)
+        if changed is None or not (changed or status['encoding']):
+            return status
@@ -6,32 +6,39 @@
 # See LICENSE.txt in the main project directory, for more information.
 
 import logging
-import simplejson
 
-from pylons import request
-
-from mediacore.lib.decorators import autocommit, memoize
+from mediacore.lib.decorators import memoize
 from mediacore.lib.helpers import download_uri, url_for
 from mediacore.lib.storage import FileStorageEngine, LocalFileStorage, StorageURI, UnsuitableEngineError, CannotTranscode
 from mediacore.lib.filetypes import guess_container_format, VIDEO
 
-from mediacoreext.simplestation.panda.lib import PANDA_URL_PREFIX, PandaException
+from mediacoreext.simplestation.panda.lib import (PANDA_URL_PREFIX,
+    PandaException, PandaHelper, loads)
 
 PANDA_ACCESS_KEY = u'panda_access_key'
 PANDA_SECRET_KEY = u'panda_secret_key'
 PANDA_CLOUD_ID = u'panda_cloud_id'
 PANDA_PROFILES = u'panda_profiles'
 PANDA_API_HOST = u'panda_api_host'
+PANDA_FALLBACK_API_HOSTS = u'panda_fallback_api_hosts'
+PANDA_PREVIEW_PROFILE = u'panda_preview_profile'
 S3_BUCKET_NAME = u's3_bucket_name'
 CLOUDFRONT_DOWNLOAD_URI = u'cloudfront_download_uri'
 CLOUDFRONT_STREAMING_URI = u'cloudfront_streaming_uri'
 
-from mediacoreext.simplestation.panda.forms.admin.storage import PandaForm
-from mediacoreext.simplestation.panda.lib import PandaHelper
-
 
 log = logging.getLogger(__name__)
 
+class _LazyFormClass(object):
+    """Resolve the settings form class the first time it is accessed.
+
+    The form module pulls in ToscaWidgets which is only needed when an admin
+    actually edits the storage engine settings.
+    """
+    def __get__(self, obj, cls):
+        from mediacoreext.simplestation.panda.forms.admin.storage import PandaForm
+        return PandaForm
+
 class PandaStorage(FileStorageEngine):
 
     engine_type = u'PandaStorage'
@@ -39,7 +46,7 @@ class PandaStorage(FileStorageEngine):
 
     default_name = u'Panda Transcoding & Storage'
 
-    settings_form_class = PandaForm
+    settings_form_class = _LazyFormClass()
     """Your :class:`mediacore.forms.Form` class for changing :attr:`_data`."""
 
     try_before = [LocalFileStorage]
@@ -55,7 +62,9 @@ class PandaStorage(FileStorageEngine):
         PANDA_SECRET_KEY: u'',
         PANDA_CLOUD_ID: u'',
         PANDA_API_HOST: u'',
+        PANDA_FALLBACK_API_HOSTS: [],
         PANDA_PROFILES: [],
+        PANDA_PREVIEW_PROFILE: u'',
         S3_BUCKET_NAME: u'',
         CLOUDFRONT_DOWNLOAD_URI: u'',
         CLOUDFRONT_STREAMING_URI: u'',
@@ -86,6 +95,8 @@ class PandaStorage(FileStorageEngine):
             access_key = self._data[PANDA_ACCESS_KEY],
             secret_key = self._data[PANDA_SECRET_KEY],
             api_host = self._data.get(PANDA_API_HOST),
+            storage_id = self.id,
+            fallback_api_hosts = self._data.get(PANDA_FALLBACK_API_HOSTS, []),
         )
 
     def parse(self, file=None, url=None):
@@ -106,7 +117,10 @@ class PandaStorage(FileStorageEngine):
         offset = len(PANDA_URL_PREFIX)
         # 'd' is the dict representing a Panda encoding or video
         # with an extra key: 'display_name'
-        d = simplejson.loads(url[offset:])
+        d = loads(url[offset:])
+        if d.get('cloud_id', self._data[PANDA_CLOUD_ID]) != self._data[PANDA_CLOUD_ID]:
+            # Encoded by another cloud, so it is stored in another bucket.
+            raise UnsuitableEngineError()
 
         # MediaCore uses extensions without prepended .
         ext = d['extname'].lstrip('.').lower()
@@ -152,7 +166,12 @@ class PandaStorage(FileStorageEngine):
         or not download_uri(media_file):
             raise CannotTranscode
 
-        panda_helper = self.panda_helper()
+        helper = self.panda_helper()
+        if helper.get_transcode_job(media_file):
+            # Already queued by another Panda storage engine (cloud). The
+            # worker decides which cloud gets to encode it.
+            return
+
         state_update_url = url_for(
             controller='/panda/admin/media',
             action='panda_update',
@@ -160,19 +179,26 @@ class PandaStorage(FileStorageEngine):
             qualified=True
         )
 
-        # We can only tell panda to encode this video once the transaction has
-        # been committed, otherwise panda get's a 404 when they try to download
-        # the file from us.
-        def transcode():
-            try:
-                panda_helper.transcode_media_file(media_file, profile_names,
-                                                  state_update_url=state_update_url)
-            except PandaException, e:
-                log.exception(e)
-
-        # Use the autocommit decorator to save the changes to the db.
-        autocommitted_transcode = autocommit(transcode)
-        request.commit_callbacks.append(autocommitted_transcode)
+        # With a preview profile configured, that one is encoded first and
+        # published as soon as it's done; the rest of the profiles follow.
+        preview_profile = self._data.get(PANDA_PREVIEW_PROFILE)
+        deferred_profiles = []
+        if preview_profile:
+            deferred_profiles = [n for n in profile_names if n != preview_profile]
+            profile_names = [preview_profile]
+
+        # The job is committed along with the upload and submitted to Panda
+        # by the panda-worker command. It can't be sent any earlier anyway:
+        # Panda would get a 404 when trying to download an uncommitted file.
+        # The worker also probes and fingerprints the file beforehand, so
+        # the upload request doesn't have to read it again.
+        try:
+            helper.queue_transcode(media_file, profile_names,
+                                   state_update_url=state_update_url,
+                                   deferred_profiles=deferred_profiles)
+        except PandaException, e:
+            log.exception(e)
+            return
 
     def get_uris(self, media_file):
         """Return a list of URIs from which the stored file can be accessed.
@@ -0,0 +1,115 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+"""Decode large Panda listings one element at a time.
+
+``/videos.json`` and ``/encodings.json`` return every video or encoding of
+the cloud in a single JSON array. Reading the whole response and decoding it
+in one go keeps both the text and the full object graph in memory at the
+same time. :func:`split_array` instead cuts the array into the JSON text of
+its elements as the response is read, so only one element has to be held
+as text at any time.
+"""
+
+import re
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+class NotAnArray(ValueError):
+    """The response is not a JSON array, e.g. because it's an error object.
+
+    :attr text: The complete response body.
+    """
+    def __init__(self, text):
+        ValueError.__init__(self, 'Response is not a JSON array.')
+        self.text = text
+
+def read_chunks(response, chunk_size=CHUNK_SIZE):
+    """Yield the body of a :class:`httplib.HTTPResponse` in chunks."""
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def gunzip(chunks):
+    """Decompress a gzip encoded stream of chunks."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+# All characters that change the parser state. Everything else, including
+# the bytes of multi-byte UTF-8 sequences, is copied as it is.
+_special = re.compile(r'["\\\[\]{},]')
+
+def split_array(chunks):
+    """Yield the JSON text of each element of a top-level JSON array.
+
+    :param chunks: An iterable of strings which together form the document.
+    :raises NotAnArray: If the document isn't an array.
+    """
+    chunks = iter(chunks)
+    started = False
+    depth = 0
+    in_string = False
+    carry_skip = False
+    pieces = []
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            if chunk[0] != '[':
+                raise NotAnArray(chunk + ''.join(chunks))
+            started = True
+            element_start = 1
+        else:
+            element_start = 0
+        # Characters before this position are escaped and must be ignored.
+        skip = carry_skip and 1 or 0
+        carry_skip = False
+
+        for match in _special.finditer(chunk, element_start):
+            i = match.start()
+            if i < skip:
+                continue
+            c = chunk[i]
+            if in_string:
+                if c == '"':
+                    in_string = False
+                elif c == '\\':
+                    skip = i + 2
+                    carry_skip = skip > len(chunk)
+            elif c == '"':
+                in_string = True
+            elif c in '[{':
+                depth += 1
+            elif c in ']}':
+                if depth:
+                    depth -= 1
+                    continue
+                # The end of the array.
+                pieces.append(chunk[element_start:i])
+                text = ''.join(pieces).strip()
+                if text:
+                    yield text
+                return
+            elif c == ',' and not depth:
+                pieces.append(chunk[element_start:i])
+                yield ''.join(pieces)
+                pieces = []
+                element_start = i + 1
+        pieces.append(chunk[element_start:])
+    if started:
+        raise ValueError('Unterminated JSON array.')
+    raise NotAnArray('')
@@ -0,0 +1,65 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+import logging
+import threading
+import time
+from Queue import Queue, Empty
+
+log = logging.getLogger(__name__)
+
+class RateLimiter(object):
+    """Allow at most ``rate`` calls of :meth:`wait` per second, across threads."""
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+def map_concurrently(func, items, max_workers=4):
+    """Call ``func(item)`` for every item using at most ``max_workers`` threads.
+
+    Only use this for talking to Panda: the database session is bound to
+    the calling thread and must not be used from within ``func``.
+
+    :returns: A list of ``(item, result, exception)`` tuples in the order of
+        ``items``. Exactly one of ``result`` and ``exception`` is meaningful.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    todo = Queue()
+    for i, item in enumerate(items):
+        todo.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception, e:
+                results[i] = (item, None, e)
+
+    workers = [threading.Thread(target=work)
+               for x in range(min(max_workers, len(items)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return results
@@ -7,11 +7,13 @@
 
 import logging
 
-from mediacore.model.meta import DBSession
 from mediacore.plugin import events
 from mediacore.plugin.events import observes
 
-from mediacoreext.simplestation.panda.lib.storage import PandaStorage
+from mediacoreext.simplestation.panda.lib import JOB_SUBMITTED
+from mediacoreext.simplestation.panda.lib.clouds import (panda_storages,
+    storage_for_file)
+from mediacoreext.simplestation.panda.lib.stats import estimate_all
 
 log = logging.getLogger(__name__)
 
@@ -23,29 +25,46 @@ def add_routes(mapper):
     mapper.connect('/admin/plugins/panda/save',
         controller='panda/admin/settings',
         action='panda_save')
+    mapper.connect('/admin/plugins/panda/stats',
+        controller='panda/admin/stats',
+        action='index')
+    mapper.connect('/admin/plugins/panda/stats.json',
+        controller='panda/admin/stats',
+        action='report')
 
 @observes(events.Admin.MediaController.edit)
 def add_panda_vars(**result):
     media = result['media']
     result['encoding_dicts'] = encoding_dicts = {}
     result['video_dicts'] = video_dicts = {}
+    result['transcode_jobs'] = transcode_jobs = {}
+    result['encoding_etas'] = {}
     result['profile_names'] = {}
     result['display_panda_refresh_message'] = False
 
     if not media.files:
         return result
 
-    storage = DBSession.query(PandaStorage).first()
-    if not storage:
+    storages = panda_storages()
+    if not storages:
         return result
 
+    helpers = []
     for file in media.files:
-        encoding_dicts[file.id] = \
-            storage.panda_helper().get_associated_encoding_dicts(file)
-        video_dicts[file.id] = \
-            storage.panda_helper().get_associated_video_dicts(file)
+        # Each file's videos live in the cloud it was submitted to.
+        helper = storage_for_file(file, storages).panda_helper()
+        if helper not in helpers:
+            helpers.append(helper)
+        encoding_dicts[file.id] = helper.get_associated_encoding_dicts(file)
+        video_dicts[file.id] = helper.get_associated_video_dicts(file)
+        job = helper.get_transcode_job(file)
+        if job and job['status'] != JOB_SUBMITTED:
+            # Submitted jobs show up as encodings.
+            transcode_jobs[file.id] = job
 
     if video_dicts or encoding_dicts:
-        result['profile_names'] = storage.panda_helper().get_profile_ids_names()
+        for helper in helpers:
+            result['profile_names'].update(helper.get_profile_ids_names())
+        result['encoding_etas'] = estimate_all(encoding_dicts, video_dicts)
 
     return result
@@ -0,0 +1,125 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+import time
+import unittest
+
+from mediacoreext.simplestation.panda.lib import hosts
+from mediacoreext.simplestation.panda.lib.hosts import (COOLDOWN, MAX_COOLDOWN,
+    PROBE_INTERVAL, HostHealth, host_health, rank_hosts)
+
+HOSTS = ['a.example.com', 'b.example.com', 'c.example.com']
+
+def used(host, latency, errors=0, ago=0):
+    """Record a successful call of ``latency`` seconds, then ``errors`` failures."""
+    health = host_health(host)
+    health.record(latency, True)
+    for i in range(errors):
+        health.record(latency, False)
+    health.last_used = health.last_failure = time.time() - ago
+    return health
+
+class HostHealthTest(unittest.TestCase):
+    def test_rolling_averages(self):
+        health = HostHealth('a')
+        health.record(1.0, True)
+        self.assertEqual(health.latency, 1.0)
+        health.record(2.0, True)
+        self.assertAlmostEqual(health.latency, 1.2)
+        health.record(5.0, False)
+        # Failed calls don't count towards the latency.
+        self.assertAlmostEqual(health.latency, 1.2)
+        self.assertAlmostEqual(health.error_rate, 0.2)
+        self.assertEqual((health.calls, health.errors, health.failures), (3, 1, 1))
+
+    def test_cost_counts_errors(self):
+        health = HostHealth('a')
+        self.assertEqual(health.cost(), None)
+        health.record(1.0, True)
+        self.assertEqual(health.cost(), 1.0)
+        health.record(1.0, False)
+        self.assertAlmostEqual(health.cost(), 1.25)
+
+    def test_cooldown_doubles_up_to_max(self):
+        health = HostHealth('a')
+        self.assertFalse(health.cooling_down())
+        health.record(1.0, False)
+        now = health.last_failure
+        self.assertTrue(health.cooling_down(now + COOLDOWN - 1))
+        self.assertFalse(health.cooling_down(now + COOLDOWN + 1))
+        health.record(1.0, False)
+        now = health.last_failure
+        self.assertTrue(health.cooling_down(now + 2 * COOLDOWN - 1))
+        for i in range(20):
+            health.record(1.0, False)
+        now = health.last_failure
+        self.assertFalse(health.cooling_down(now + MAX_COOLDOWN + 1))
+
+    def test_success_ends_cooldown(self):
+        health = HostHealth('a')
+        health.record(1.0, False)
+        health.record(1.0, True)
+        self.assertFalse(health.cooling_down())
+
+class RankHostsTest(unittest.TestCase):
+    def setUp(self):
+        hosts._health.clear()
+
+    def tearDown(self):
+        hosts._health.clear()
+
+    def test_unused_hosts_in_configured_order(self):
+        self.assertEqual(rank_hosts(HOSTS), HOSTS)
+        self.assertEqual(rank_hosts(list(reversed(HOSTS))),
+                         list(reversed(HOSTS)))
+
+    def test_used_hosts_before_unused(self):
+        used('c.example.com', 0.5)
+        self.assertEqual(rank_hosts(HOSTS),
+                         ['c.example.com', 'a.example.com', 'b.example.com'])
+
+    def test_cheapest_first(self):
+        used('a.example.com', 0.3)
+        used('b.example.com', 0.1)
+        used('c.example.com', 0.2)
+        self.assertEqual(rank_hosts(HOSTS),
+                         ['b.example.com', 'c.example.com', 'a.example.com'])
+
+    def test_error_rate_raises_cost(self):
+        # Half of the calls failed, doubling the expected time.
+        used('a.example.com', 0.1, errors=3, ago=COOLDOWN * 4 + 1)
+        used('b.example.com', 0.15)
+        self.assertEqual(rank_hosts(HOSTS)[0], 'b.example.com')
+
+    def test_cooling_down_last(self):
+        used('a.example.com', 0.1, errors=1)
+        used('b.example.com', 0.3)
+        self.assertEqual(rank_hosts(HOSTS),
+                         ['b.example.com', 'c.example.com', 'a.example.com'])
+
+    def test_cooling_down_in_configured_order(self):
+        used('b.example.com', 0.1, errors=1)
+        used('a.example.com', 0.3, errors=2)
+        self.assertEqual(rank_hosts(HOSTS),
+                         ['c.example.com', 'a.example.com', 'b.example.com'])
+
+    def test_back_after_cooldown(self):
+        used('a.example.com', 0.1, errors=1, ago=COOLDOWN + 1)
+        used('b.example.com', 0.3)
+        self.assertEqual(rank_hosts(HOSTS)[0], 'a.example.com')
+
+    def test_stale_host_probed_first(self):
+        used('a.example.com', 1.0, ago=PROBE_INTERVAL + 1)
+        used('b.example.com', 0.1)
+        self.assertEqual(rank_hosts(HOSTS),
+                         ['a.example.com', 'b.example.com', 'c.example.com'])
+
+    def test_stale_host_cooling_down_not_probed(self):
+        health = used('a.example.com', 1.0, errors=20, ago=PROBE_INTERVAL + 1)
+        self.assertTrue(health.cooling_down())
+        used('b.example.com', 0.1)
+        self.assertEqual(rank_hosts(HOSTS)[-1], 'a.example.com')
@@ -0,0 +1,104 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+import unittest
+
+from mediacoreext.simplestation.panda.lib import (JOB_PENDING, JOB_SUBMITTED,
+    PRIORITY_BACKFILL, PRIORITY_REPUBLISH, PRIORITY_UPLOAD)
+from mediacoreext.simplestation.panda.lib.scheduler import Scheduler
+
+NOW = 100000.0
+
+def job(priority, profiles, status=JOB_PENDING, created=NOW, next_attempt=NOW):
+    j = {
+        'priority': priority,
+        'profiles': ['p%d' % i for i in range(profiles)],
+        'status': status,
+        'created': created,
+        'next_attempt': next_attempt,
+    }
+    if status == JOB_SUBMITTED:
+        j.update(encodings=profiles, submitted_at=NOW - 60)
+    return j
+
+def sizes(jobs):
+    return [len(j['profiles']) for j in jobs]
+
+class SchedulerTest(unittest.TestCase):
+    def test_caps_are_shares_of_the_capacity(self):
+        scheduler = Scheduler(8)
+        self.assertEqual(8, scheduler.caps[PRIORITY_UPLOAD])
+        self.assertEqual(4, scheduler.caps[PRIORITY_REPUBLISH])
+        self.assertEqual(2, scheduler.caps[PRIORITY_BACKFILL])
+        self.assertEqual(1, Scheduler(1).caps[PRIORITY_BACKFILL])
+
+    def test_jobs_must_fit_the_capacity(self):
+        jobs = [job(PRIORITY_UPLOAD, 5), job(PRIORITY_UPLOAD, 5),
+                job(PRIORITY_UPLOAD, 3)]
+        self.assertEqual([5, 3], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_jobs_must_fit_their_share(self):
+        jobs = [job(PRIORITY_REPUBLISH, 3), job(PRIORITY_REPUBLISH, 2),
+                job(PRIORITY_REPUBLISH, 1)]
+        self.assertEqual([3, 1], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_submitted_jobs_count_as_in_flight(self):
+        jobs = [job(PRIORITY_UPLOAD, 6, status=JOB_SUBMITTED),
+                job(PRIORITY_UPLOAD, 3), job(PRIORITY_UPLOAD, 2)]
+        self.assertEqual([2], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_stale_submissions_no_longer_count(self):
+        stale = job(PRIORITY_UPLOAD, 8, status=JOB_SUBMITTED)
+        stale['submitted_at'] = NOW - 7 * 3600
+        jobs = [stale, job(PRIORITY_UPLOAD, 3)]
+        self.assertEqual([3], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_oversized_job_runs_when_its_class_is_idle(self):
+        # The backfill share is 2, a 5 profile ladder never fits it.
+        jobs = [job(PRIORITY_BACKFILL, 5), job(PRIORITY_BACKFILL, 1)]
+        self.assertEqual([5], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_oversized_job_waits_for_its_class(self):
+        jobs = [job(PRIORITY_BACKFILL, 1, status=JOB_SUBMITTED),
+                job(PRIORITY_BACKFILL, 5)]
+        self.assertEqual([], Scheduler(8).select(jobs, NOW))
+
+    def test_oversized_job_must_fit_a_busy_cloud(self):
+        jobs = [job(PRIORITY_UPLOAD, 5, status=JOB_SUBMITTED),
+                job(PRIORITY_BACKFILL, 4)]
+        self.assertEqual([], Scheduler(8).select(jobs, NOW))
+        jobs = [job(PRIORITY_UPLOAD, 4, status=JOB_SUBMITTED),
+                job(PRIORITY_BACKFILL, 4)]
+        self.assertEqual([4], sizes(Scheduler(8).select(jobs, NOW)))
+
+    def test_job_larger_than_the_capacity_runs_on_an_idle_cloud(self):
+        self.assertEqual([12], sizes(Scheduler(8).select(
+            [job(PRIORITY_UPLOAD, 12)], NOW)))
+        self.assertEqual([], Scheduler(8).select(
+            [job(PRIORITY_UPLOAD, 12), job(PRIORITY_BACKFILL, 1,
+                                           status=JOB_SUBMITTED)], NOW))
+
+    def test_uploads_go_first(self):
+        jobs = [job(PRIORITY_BACKFILL, 1, created=NOW - 10),
+                job(PRIORITY_UPLOAD, 1)]
+        selected = Scheduler(8).select(jobs, NOW)
+        self.assertEqual(PRIORITY_UPLOAD, selected[0]['priority'])
+
+    def test_waiting_jobs_move_up(self):
+        jobs = [job(PRIORITY_BACKFILL, 1, created=NOW - 3 * 900),
+                job(PRIORITY_UPLOAD, 1)]
+        selected = Scheduler(8, aging=900).select(jobs, NOW)
+        self.assertEqual(PRIORITY_BACKFILL, selected[0]['priority'])
+
+    def test_jobs_due_later_are_left_alone(self):
+        jobs = [job(PRIORITY_UPLOAD, 1, next_attempt=NOW + 60)]
+        self.assertEqual([], Scheduler(8).select(jobs, NOW))
+
+    def test_jobs_without_priority_are_uploads(self):
+        j = job(PRIORITY_UPLOAD, 8)
+        del j['priority']
+        self.assertEqual([j], Scheduler(8).select([j], NOW))
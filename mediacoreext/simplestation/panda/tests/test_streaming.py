@@ -0,0 +1,101 @@
+# This file is a part of the Panda plugin for MediaCore CE,
+# Copyright 2011-2013 MediaCore Inc., Felix Schwarz and other contributors.
+# For the exact contribution history, see the git revision log.
+# The source code contained in this file is licensed under the GPLv3 or
+# (at your option) any later version.
+# See LICENSE.txt in the main project directory, for more information.
+
+import gzip
+import json
+import unittest
+from StringIO import StringIO
+
+from mediacoreext.simplestation.panda.lib.streaming import (NotAnArray,
+    gunzip, split_array)
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def elements(text, size=None):
+    chunks = size and chunked(text, size) or [text]
+    return [json.loads(e) for e in split_array(chunks)]
+
+class SplitArrayTest(unittest.TestCase):
+    def test_elements(self):
+        self.assertEqual(elements('[1, "two", {"three": 3}]'),
+                         [1, 'two', {'three': 3}])
+
+    def test_empty_array(self):
+        self.assertEqual(elements('[]'), [])
+        self.assertEqual(elements('  [ \n ]  '), [])
+
+    def test_nested_objects(self):
+        data = [{'id': 'a', 'tags': [1, [2, 3]], 'meta': {'x': {'y': []}}},
+                {'id': 'b', 'tags': [], 'meta': {}}]
+        self.assertEqual(elements(json.dumps(data)), data)
+
+    def test_special_characters_in_strings(self):
+        data = [{'name': 'a, b [c] {d}'}, u'caf\xe9', 'x"y\\z']
+        text = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        result = [json.loads(e.decode('utf-8')) for e in split_array([text])]
+        self.assertEqual(result, data)
+
+    def test_every_chunk_size(self):
+        data = [{'id': 'a', 'file': 'C:\\videos\\', 'title': 'say "hi", [ok]'},
+                {'id': 'b', 'escapes': '\\"\\\\', 'nested': {'list': [1, 2]}},
+                'tail\\']
+        text = json.dumps(data)
+        for size in range(1, len(text) + 1):
+            self.assertEqual(elements(text, size), data, 'chunk size %d' % size)
+
+    def test_escape_split_across_chunks(self):
+        # The backslash ends one chunk, the escaped quote starts the next.
+        chunks = ['["a\\', '"b", "c\\\\', '", "d"]']
+        self.assertEqual([json.loads(e) for e in split_array(chunks)],
+                         ['a"b', 'c\\', 'd'])
+
+    def test_leading_whitespace_and_empty_chunks(self):
+        chunks = ['', '  \n', '', ' [1', '', ',2]']
+        self.assertEqual([json.loads(e) for e in split_array(chunks)], [1, 2])
+
+    def test_stops_at_end_of_array(self):
+        # Whatever follows the array is never read.
+        def chunks():
+            yield '[1, 2]'
+            raise AssertionError('Read past the end of the array.')
+        self.assertEqual([json.loads(e) for e in split_array(chunks())], [1, 2])
+
+    def test_not_an_array(self):
+        text = '{"error": "NotAuthorized", "message": "nope"}'
+        try:
+            list(split_array(chunked(text, 5)))
+        except NotAnArray, e:
+            self.assertEqual(e.text, text)
+        else:
+            self.fail('NotAnArray not raised')
+
+    def test_empty_document(self):
+        self.assertRaises(NotAnArray, list, split_array([]))
+        self.assertRaises(NotAnArray, list, split_array(['', '  ']))
+
+    def test_unterminated_array(self):
+        self.assertRaises(ValueError, list, split_array(['[1, 2', ', 3']))
+        self.assertRaises(ValueError, list, split_array(['["a]']))
+
+    def test_unterminated_array_is_not_not_an_array(self):
+        try:
+            list(split_array(['[{"a": 1}']))
+        except NotAnArray:
+            self.fail('NotAnArray raised for a truncated array')
+        except ValueError:
+            pass
+
+class GunzipTest(unittest.TestCase):
+    def test_gunzip(self):
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write('[1, 2, 3]' * 1000)
+        f.close()
+        compressed = buf.getvalue()
+        self.assertEqual(''.join(gunzip(chunked(compressed, 7))),
+                         '[1, 2, 3]' * 1000)
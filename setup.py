@@ -29,6 +29,15 @@ setup(
     entry_points = '''
         [mediacore.plugin]
         panda = mediacoreext.simplestation.panda.mediacore_plugin
+
+        [paste.global_paster_command]
+        panda-worker = mediacoreext.simplestation.panda.commands:WorkerCommand
+        panda-transcode = mediacoreext.simplestation.panda.commands:TranscodeCommand
+        panda-cleanup = mediacoreext.simplestation.panda.commands:CleanupCommand
+        panda-profiles = mediacoreext.simplestation.panda.commands:ProfilesCommand
+
+        [paste.filter_app_factory]
+        panda_profiler = mediacoreext.simplestation.panda.lib.profiler:make_profiler_filter
     ''',
     message_extractors = {'mediacoreext/simplestation/panda': [
         ('**.py', 'python', None),